@@ -0,0 +1,34 @@
+
+import geostream as gs
+
+from time import time
+import random
+
+from shapely.geometry import Point
+
+# compares the sql and batch engines of compute and aggregate
+
+TESTFILE = 'batchtest.db'
+N = 50000
+
+workspace = gs.Workspace(TESTFILE, 'w')
+table = workspace.new_table('circles', [('id','int'), ('grp','int'), ('geom','geom')], replace=True)
+workspace.begin()
+table.add_rows(((i, i % 10, Point(random.uniform(-180,180), random.uniform(-90,90)).buffer(1, resolution=16))
+                for i in xrange(N)))
+workspace.commit()
+
+for expr in ['st_area(geom)', 'st_area(st_buffer(geom, 0.5))', 'st_length(geom)']:
+    for engine in ['sql', 'batch']:
+        t = time()
+        table.compute('value', expr, dtype='real' if 'value' not in table.fieldnames else None, engine=engine)
+        elapsed = time()-t
+        print expr, engine, '{:.0f} rows/sec'.format(N / elapsed)
+
+for engine in ['sql', 'batch']:
+    t = time()
+    agg = table.aggregate(['SUM(st_area(st_buffer(geom, 0.5)))'], by='grp', engine=engine)
+    elapsed = time()-t
+    print 'aggregate', engine, '{:.0f} rows/sec'.format(N / elapsed)
+
+workspace.delete(True)
@@ -0,0 +1,44 @@
+
+import geostream as gs
+
+from time import time
+import os
+import random
+
+from shapely.geometry import Point
+
+# file size and decode speed of a polygon layer stored with each geometry codec
+
+TESTFILE = 'codectest.db'
+N = 20000
+
+def source():
+    random.seed(1)
+    for i in xrange(N):
+        x,y = random.uniform(-180,180), random.uniform(-90,90)
+        yield i, Point(x, y).buffer(random.uniform(0.1,1), resolution=32)
+
+for codec,precision,compression in [('wkb',None,None),
+                                    ('compact',6,None),
+                                    ('compact',3,None),
+                                    ('compact',6,'zlib')]:
+    workspace = gs.Workspace(TESTFILE, 'w')
+    table = workspace.new_table('polys', [('id','int'), ('geom','geom')])
+    table.set_geometry_codec('geom', codec, precision, compression)
+    t = time()
+    workspace.begin()
+    table.add_rows(source())
+    workspace.commit()
+    encoding = time()-t
+    workspace._fetchall('VACUUM')
+    size = os.path.getsize(TESTFILE)
+
+    t = time()
+    for geom in table.values('geom'):
+        # geometries are returned as lazy proxies, so parse each one
+        geom.geom
+    decoding = time()-t
+
+    print codec, precision, compression, '{:.1f} MB'.format(size / 1024.0**2),
+    print 'encode {:.0f} rows/sec'.format(N / encoding), 'decode {:.0f} rows/sec'.format(N / decoding)
+    workspace.delete(True)
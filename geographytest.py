@@ -0,0 +1,32 @@
+
+import geostream as gs
+from geostream.vector import geography
+
+from time import time
+
+from shapely.geometry import Point
+
+# planar versus geodesic area and length of a detailed lon/lat polygon, for each available geodesic backend
+
+def geom_area(geom):
+    return geom.area
+
+def geom_length(geom):
+    return geom.length
+
+def timed(descr, func, obj):
+    t=time()
+    for _ in range(100):
+        res = func(obj)
+    print descr, time()-t, res
+
+geom = Point(10, 60).buffer(5, resolution=256).difference(Point(10, 60).buffer(1, resolution=64))
+
+timed('area geom', geom_area, geom)
+timed('length geom', geom_length, geom)
+
+for backend in geography.BACKENDS:
+    geography.set_backend(backend)
+    timed('area geog ({})'.format(backend), geography.geodesic_area, geom)
+    timed('length geog ({})'.format(backend), geography.geodesic_length, geom)
+
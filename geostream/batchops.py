@@ -0,0 +1,157 @@
+
+import re
+from collections import OrderedDict
+
+import numpy as np
+from shapely.geometry import Point
+
+from .vector import geography
+from .vector.serialize import from_wkb, shapely_to_wkb
+
+# Batch versions of the st_* functions in ops.py, used by the "batch" engine of
+# Table.compute and Table.aggregate.
+# Instead of sqlite calling back into python once per row and function, a chunk of
+# rows is read at a time, the geometries decoded into numpy object arrays, and each
+# function applied to the whole array as a numpy ufunc. Nested calls, eg
+# st_area(st_buffer(geom, 10)), pass the geometries between them without
+# serializing in between. Only the final results are written back to sqlite.
+
+
+def _nullsafe(func):
+    # like the sql functions, return NULL if any argument is NULL
+    def wrapped(*args):
+        for arg in args:
+            if arg is None:
+                return None
+        return func(*args)
+    return wrapped
+
+def _ufunc(func, nargs):
+    return np.frompyfunc(_nullsafe(func), nargs, 1)
+
+# name: (argument types, return type, ufunc)
+FUNCS = {
+    'st_point': (('num','num'), 'geom', _ufunc(lambda x,y: Point(x, y), 2)),
+
+    'st_area': (('geom',), 'num', _ufunc(lambda g: g.area, 1)),
+    'st_length': (('geom',), 'num', _ufunc(lambda g: g.length, 1)),
+    'st_geodesic_area': (('geom',), 'num', _ufunc(geography.geodesic_area, 1)),
+    'st_geodesic_length': (('geom',), 'num', _ufunc(geography.geodesic_length, 1)),
+    'st_buffer': (('geom','num'), 'geom', _ufunc(lambda g,dist: g.buffer(dist), 2)),
+
+    'st_intersection': (('geom','geom'), 'geom', _ufunc(lambda g,o: g.intersection(o), 2)),
+    'st_union': (('geom','geom'), 'geom', _ufunc(lambda g,o: g.union(o), 2)),
+    'st_difference': (('geom','geom'), 'geom', _ufunc(lambda g,o: g.difference(o), 2)),
+    }
+
+for _name in ('intersects','disjoint','contains','within','covers','touches','crosses','overlaps'):
+    FUNCS['st_'+_name] = (('geom','geom'), 'bool', _ufunc(lambda g,o,_name=_name: getattr(g, _name)(o), 2))
+
+# the st_xmin etc bbox getters are left to sqlite, since they only read the geom
+# header and calling them from a ufunc is slower than letting sqlite call them
+
+# parsing
+
+_call = re.compile(r'\b(st_\w+)\s*\(([^()]*)\)', re.IGNORECASE)
+_field = re.compile(r'^[A-Za-z_]\w*$')
+_number = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+def parse(exprs):
+    '''Rewrites a list of sql expressions so that any st_* calls that can be run in
+    batch are replaced with references to temporary value columns named _v0, _v1, etc.
+    Calls can be nested, but their arguments must be field names, numbers, or other
+    batch calls. Anything else is left for sqlite to evaluate as usual.
+    Returns the rewritten expressions, the batch steps as (name, func, args) tuples
+    in order of evaluation, the fields they need as a dict of field name to whether
+    it is a geometry, and the names of the values referenced by the rewritten expressions.
+    '''
+    steps = []
+    fields = OrderedDict()
+
+    def batchcall(match):
+        func = match.group(1).lower()
+        args = [arg.strip() for arg in match.group(2).split(',')]
+        if func not in FUNCS or len(args) != len(FUNCS[func][0]):
+            return match.group(0)
+        parsed = []
+        for arg,typ in zip(args, FUNCS[func][0]):
+            if _number.match(arg):
+                parsed.append(('number', float(arg)))
+            elif _field.match(arg):
+                if arg in (name for name,_,_ in steps):
+                    parsed.append(('value', arg))
+                else:
+                    fields[arg] = fields.get(arg, False) or typ == 'geom'
+                    parsed.append(('field', arg))
+            else:
+                return match.group(0)
+        if all(kind == 'number' for kind,_ in parsed):
+            # constant, nothing to batch
+            return match.group(0)
+        name = '_v{}'.format(len(steps))
+        steps.append((name, func, parsed))
+        return name
+
+    rewritten = []
+    for expr in exprs:
+        # replace innermost calls until nothing more can be replaced
+        while True:
+            new = _call.sub(batchcall, expr)
+            if new == expr:
+                break
+            expr = new
+        rewritten.append(expr)
+
+    outputs = [name for name,_,_ in steps
+               if any(re.search(r'\b{}\b'.format(name), expr) for expr in rewritten)]
+    return rewritten, steps, fields, outputs
+
+# evaluation
+
+def _array(values):
+    # fill one by one, so that geometries are not converted to coordinate arrays
+    arr = np.empty(len(values), dtype=object)
+    for i,val in enumerate(values):
+        arr[i] = val
+    return arr
+
+_decode = _ufunc(from_wkb, 1)
+
+def evaluate(steps, columns, outputs):
+    '''Runs the parsed batch steps on a chunk of rows.
+    columns is a dict of field name to the list of values of each row, with geometries
+    as raw wkb blobs. Each geometry field is only decoded once, and only if needed.
+    Returns the list of sql values of each output, in the same order.
+    '''
+    arrays = dict((field, _array(values)) for field,values in columns.items())
+    decoded = {}
+    types = {}
+    for name,func,args in steps:
+        argtypes,rettype,ufunc = FUNCS[func]
+        argvals = []
+        for (kind,arg),typ in zip(args, argtypes):
+            if kind == 'field' and typ == 'geom':
+                if arg not in decoded:
+                    decoded[arg] = _decode(arrays[arg])
+                argvals.append(decoded[arg])
+            elif kind in ('field','value'):
+                argvals.append(arrays[arg])
+            else:
+                argvals.append(arg)
+        arrays[name] = ufunc(*argvals)
+        types[name] = rettype
+
+    results = []
+    for name in outputs:
+        if types[name] == 'geom':
+            values = [shapely_to_wkb(val) if val is not None else None
+                      for val in arrays[name]]
+        elif types[name] == 'bool':
+            values = [int(val) if val is not None else None
+                      for val in arrays[name]]
+        else:
+            values = arrays[name].tolist()
+        results.append(values)
+    return results
+
+
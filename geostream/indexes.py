@@ -1,6 +1,12 @@
 
 import sqlite3
 from sqlite3 import Binary
+import math
+import itertools
+import warnings
+from struct import pack, unpack_from
+
+from .verbose import track_progress
 
 ##from rtree.index import Index
 ##
@@ -23,11 +29,448 @@ from sqlite3 import Binary
 class Spatial_Index_Manager:
     pass
 
-class RTreeIndex:
-    pass
+class RTreeIndex(object):
+    '''Spatial index stored inside the workspace database as an SQLite R*Tree virtual table.
+    The rtree id column is the oid of the indexed row, so it can be joined directly
+    against the indexed table. Nothing is copied out of the database, only queried.
+    '''
+    prefix = '_rtree_'
+    # prefix of the sql functions used to get the bbox of each field type
+    bboxfuncs = {'geom':'st', 'rast':'rt'}
 
-class PyramidIndex:
-    pass
+    def __init__(self, workspace, table, field):
+        self.workspace = workspace
+        self.table = table
+        self.field = field
+        self.name = '{}{}_{}'.format(self.prefix, table.replace('.','_'), field)
+
+    def __repr__(self):
+        return '<RTreeIndex: table="{}" field="{}">'.format(self.table, self.field)
+
+    def create(self):
+        query = 'CREATE VIRTUAL TABLE {} USING rtree(_oid, _xmin, _xmax, _ymin, _ymax)'.format(self.name)
+        self.workspace._fetchall(query)
+
+    def drop(self):
+        for event in ('insert','update','delete'):
+            self.workspace._fetchall('DROP TRIGGER IF EXISTS {}_{}'.format(self.name, event))
+        self.workspace._fetchall('DROP TABLE IF EXISTS {}'.format(self.name))
+
+    def create_triggers(self, typ='geom'):
+        # keep the rtree up to date whenever rows are inserted, updated or deleted
+        # typ is the field datatype, which determines the sql functions used to get the bbox
+        prefix = self.bboxfuncs[typ.lower()]
+        bboxstring = ', '.join(('{}_{}(NEW.{})'.format(prefix, coord, self.field)
+                                for coord in ('xmin','xmax','ymin','ymax')))
+        table = self.table.split('.')[-1]
+        fmt = dict(rtree=self.name, table=table, field=self.field, bbox=bboxstring, prefix=prefix)
+        self.workspace._fetchall('''CREATE TRIGGER {rtree}_insert AFTER INSERT ON {table}
+                                    WHEN {prefix}_xmin(NEW.{field}) IS NOT NULL
+                                    BEGIN
+                                        INSERT INTO {rtree} VALUES (NEW.oid, {bbox});
+                                    END;'''.format(**fmt))
+        self.workspace._fetchall('''CREATE TRIGGER {rtree}_update AFTER UPDATE OF {field} ON {table}
+                                    BEGIN
+                                        DELETE FROM {rtree} WHERE _oid = OLD.oid;
+                                        INSERT INTO {rtree} SELECT NEW.oid, {bbox}
+                                            WHERE {prefix}_xmin(NEW.{field}) IS NOT NULL;
+                                    END;'''.format(**fmt))
+        self.workspace._fetchall('''CREATE TRIGGER {rtree}_delete AFTER DELETE ON {table}
+                                    BEGIN
+                                        DELETE FROM {rtree} WHERE _oid = OLD.oid;
+                                    END;'''.format(**fmt))
+
+    def insert(self, oid, bbox):
+        xmin,ymin,xmax,ymax = bbox
+        query = 'INSERT INTO {} VALUES (?,?,?,?,?)'.format(self.name)
+        self.workspace.c.execute(query, (oid, xmin, xmax, ymin, ymax))
+
+    def insert_many(self, items):
+        # items is an iterable of (oid,xmin,xmax,ymin,ymax) tuples
+        query = 'INSERT INTO {} VALUES (?,?,?,?,?)'.format(self.name)
+        self.workspace.c.executemany(query, items)
+
+    def check(self):
+        '''Result of sqlite's rtreecheck() integrity check of the tree, 'ok' if valid,
+        or None if not available (sqlite before 3.24).
+        '''
+        try:
+            (result,), = self.workspace._fetchall('SELECT rtreecheck(?)', (self.name,))
+        except sqlite3.OperationalError:
+            return None
+        return result
+
+    def bulk_load(self, oids, bboxes, verbose=False, callback=None):
+        '''Pack a newly created and empty rtree with Sort-Tile-Recursive ordering.
+        oids is an array of row oids, and bboxes a matching (n,4) array of xmin,ymin,xmax,ymax.
+        Instead of inserting one entry at a time, the tree is built bottom up and written
+        directly to the _node, _parent and _rowid tables that sqlite uses to store the rtree.
+        This relies on sqlite's undocumented storage format of rtrees (a 4 byte node header,
+        and cells of a 64 bit id and 4 x 32 bit float coordinates, all big endian, with at most
+        51 cells per node), so the packed tree is verified with rtreecheck() afterwards.
+        If the check fails or is not available, the entries are inserted one at a time instead.
+        With verbose, or a track_progress callback, the packing time is reported per node.
+        See: https://www.sqlite.org/src/file/ext/rtree/rtree.c
+        '''
+        import numpy as np
+        if not len(oids):
+            # nothing to pack, keep the empty root node
+            return
+        (nodesize,), = self.workspace._fetchall('SELECT length(data) FROM {}_node WHERE nodeno = 1'.format(self.name))
+        # node header is 4 bytes, each cell is a 64 bit id and 4 x 32 bit float coordinates
+        capacity = min((nodesize - 4) // 24, 51) # sqlite never puts more than 51 cells in a node
+        celltype = np.dtype([('id', '>i8'), ('coords', '>f4', (4,))])
+
+        def iternodes():
+            # yields the (nodeno, data) of each node, bottom up, along with the nodeno of each cell
+            ids, boxes = np.asarray(oids, dtype=np.int64), np.asarray(bboxes, dtype=np.float64)
+            nextnode = 2 # root node is always 1
+            depth = 0
+            while True:
+                order = str_order(boxes, capacity)
+                ids, boxes = ids[order], boxes[order]
+                starts = np.arange(0, len(ids), capacity)
+                if len(starts) <= 1:
+                    nodenos = np.array([1])
+                else:
+                    nodenos = np.arange(nextnode, nextnode+len(starts))
+                    nextnode += len(starts)
+                cells = np.zeros(len(ids), dtype=celltype)
+                cells['id'] = ids
+                cells['coords'] = _float32_outward(boxes)[:,[0,2,1,3]]
+                counts = np.diff(np.append(starts, len(ids)))
+                for nodeno,start,count in itertools.izip(nodenos.tolist(), starts.tolist(), counts.tolist()):
+                    header = pack('>HH', depth if nodeno == 1 else 0, count)
+                    data = header + cells[start:start+count].tobytes()
+                    data += b'\x00' * (nodesize - len(data))
+                    yield nodeno, depth, data, ids[start:start+count]
+                if nodenos[0] == 1:
+                    break
+                # the nodes become the entries of the level above
+                ids = nodenos
+                boxes = np.column_stack([np.minimum.reduceat(boxes[:,0], starts),
+                                         np.minimum.reduceat(boxes[:,1], starts),
+                                         np.maximum.reduceat(boxes[:,2], starts),
+                                         np.maximum.reduceat(boxes[:,3], starts)])
+                depth += 1
+
+        nodes = iternodes()
+        if verbose or callback:
+            kwargs = dict(callback=callback) if callback else {}
+            nodes = track_progress(nodes, 'Packing Spatial Index for Field "{}" on Table "{}"'.format(self.field, self.table), **kwargs)
+
+        cur = self.workspace.c
+        for shadow in ('node','parent','rowid'):
+            cur.execute('DELETE FROM {}_{}'.format(self.name, shadow))
+        for nodeno,depth,data,childids in nodes:
+            cur.execute('INSERT INTO {}_node (nodeno, data) VALUES (?,?)'.format(self.name), (nodeno, Binary(data)))
+            if depth == 0:
+                # leaf cells are rows
+                cur.executemany('INSERT INTO {}_rowid (rowid, nodeno) VALUES (?,?)'.format(self.name),
+                                ((oid,nodeno) for oid in childids.tolist()))
+            else:
+                # other cells are child nodes
+                cur.executemany('INSERT INTO {}_parent (nodeno, parentnode) VALUES (?,?)'.format(self.name),
+                                ((child,nodeno) for child in childids.tolist()))
+
+        result = self.check()
+        if result != 'ok':
+            warnings.warn('Packed spatial index for field "{}" on table "{}" could not be verified ({}), '
+                          'inserting one entry at a time instead'.format(self.field, self.table, result or 'rtreecheck not available'))
+            self.drop()
+            self.create()
+            bboxes = np.asarray(bboxes, dtype=np.float64)
+            self.insert_many(itertools.izip(np.asarray(oids).tolist(), bboxes[:,0].tolist(), bboxes[:,2].tolist(),
+                                            bboxes[:,1].tolist(), bboxes[:,3].tolist()))
+
+    def intersection(self, bbox):
+        # bbox must be in xmin,ymin,xmax,ymax order
+        xmin,ymin,xmax,ymax = bbox
+        query = 'SELECT _oid FROM {} WHERE _xmax >= ? AND _xmin <= ? AND _ymax >= ? AND _ymin <= ?'.format(self.name)
+        cur = self.workspace._cursor()
+        return (row[0] for row in cur.execute(query, (xmin, xmax, ymin, ymax)))
+
+class TileGridIndex(object):
+    '''Index of a raster table whose tiles were cut from a single raster, as done by import_raster.
+    Each row stores the tile_row and tile_col of its tile, and the affine transform, tile size and
+    raster size are registered in the raster_grids metatable. The tiles that intersect a bbox are
+    then found arithmetically and fetched with a range lookup on an ordinary sql index,
+    without reading any tile headers and without an rtree.
+    '''
+    fields = ('tile_row', 'tile_col')
+
+    def __init__(self, workspace, table, field='rast'):
+        self.workspace = workspace
+        self.table = table
+        self.field = field
+        self.indexname = 'idx_{}_tile_row_tile_col'.format(table.replace('.','_'))
+
+    def __repr__(self):
+        return '<TileGridIndex: table="{}" field="{}">'.format(self.table, self.field)
+
+    def grid(self):
+        '''The registered (affine, (tilewidth, tileheight), (width, height)) of the table,
+        where affine is a 6 coefficient list and sizes are in pixels, or None if not registered.
+        '''
+        if 'raster_grids' not in self.workspace.metatablenames:
+            return None
+        rows = self.workspace._fetchall('''SELECT xscale, xskew, xoff, yskew, yscale, yoff, tilewidth, tileheight, width, height
+                                          FROM raster_grids WHERE tbl = ? AND col = ?''', (self.table, self.field))
+        if not rows:
+            return None
+        xscale,xskew,xoff,yskew,yscale,yoff,tilewidth,tileheight,width,height = rows[0]
+        return [xscale,xskew,xoff,yskew,yscale,yoff], (tilewidth,tileheight), (width,height)
+
+    def exists(self):
+        return self.grid() is not None
+
+    def skipped(self):
+        '''Number of tiles in the grid that were not stored because they only contained nodata,
+        or None if not registered.
+        '''
+        if 'raster_grids' not in self.workspace.metatablenames:
+            return None
+        if 'skipped' not in self.workspace.table('raster_grids').fieldnames:
+            # read only workspace from before tiles could be skipped
+            return 0 if self.exists() else None
+        rows = self.workspace._fetchall('SELECT skipped FROM raster_grids WHERE tbl = ? AND col = ?', (self.table, self.field))
+        return rows[0][0] if rows else None
+
+    def create(self, affine, tilesize, size, skipped=0):
+        self.drop()
+        xscale,xskew,xoff,yskew,yscale,yoff = list(affine)[:6]
+        (tilewidth,tileheight),(width,height) = tilesize,size
+        self.workspace._fetchall('''INSERT INTO raster_grids (tbl, col, xscale, xskew, xoff, yskew, yscale, yoff,
+                                                               tilewidth, tileheight, width, height, skipped)
+                                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                                 (self.table, self.field, xscale, xskew, xoff, yskew, yscale, yoff,
+                                  tilewidth, tileheight, width, height, skipped))
+        self.workspace._fetchall('CREATE INDEX IF NOT EXISTS {} ON {} (tile_row, tile_col)'.format(self.indexname, self.table))
+
+    def drop(self):
+        if 'raster_grids' in self.workspace.metatablenames:
+            self.workspace._fetchall('DELETE FROM raster_grids WHERE tbl = ? AND col = ?', (self.table, self.field))
+        self.workspace._fetchall('DROP INDEX IF EXISTS {}'.format(self.indexname))
+
+    def ranges(self, bbox):
+        '''The (firstrow, lastrow, firstcol, lastcol) of the tiles intersecting a bbox in xmin,ymin,xmax,ymax order,
+        or None if the bbox is outside the raster. Like the rtree, tiles that only touch the bbox are included.
+        '''
+        from affine import Affine
+        affine,(tilewidth,tileheight),(width,height) = self.grid()
+        inverse = ~Affine(*affine)
+        xmin,ymin,xmax,ymax = bbox
+        pxs,pys = zip(*[inverse * (x,y) for x,y in [(xmin,ymin),(xmin,ymax),(xmax,ymin),(xmax,ymax)]])
+        pxmin,pxmax,pymin,pymax = min(pxs),max(pxs),min(pys),max(pys)
+        # allow for rounding errors, so that tiles touching the bbox are included
+        eps = 1e-6
+        if pxmin > width + eps or pxmax < -eps or pymin > height + eps or pymax < -eps:
+            return None
+        cols = int(math.ceil(width / float(tilewidth)))
+        rows = int(math.ceil(height / float(tileheight)))
+        firstcol = max(int(math.ceil(pxmin / tilewidth - eps)) - 1, 0)
+        lastcol = min(int(math.floor(pxmax / tilewidth + eps)), cols - 1)
+        firstrow = max(int(math.ceil(pymin / tileheight - eps)) - 1, 0)
+        lastrow = min(int(math.floor(pymax / tileheight + eps)), rows - 1)
+        return firstrow, lastrow, firstcol, lastcol
+
+def _float32_outward(bboxes):
+    # rtree coordinates are 32 bit floats, so round mins down and maxs up
+    # to make sure the stored bbox always contains the original bbox
+    import numpy as np
+    rounded = bboxes.astype(np.float32)
+    mins, maxs = rounded[:,:2], rounded[:,2:]
+    down = mins > bboxes[:,:2]
+    mins[down] = np.nextafter(mins[down], np.float32(-np.inf))
+    up = maxs < bboxes[:,2:]
+    maxs[up] = np.nextafter(maxs[up], np.float32(np.inf))
+    return rounded
+
+def str_order(bboxes, capacity):
+    '''Sort-Tile-Recursive packing order for an array of xmin,ymin,xmax,ymax bboxes.
+    Returns the indices of the bboxes in the order they should be inserted,
+    so that consecutive runs of capacity items make up spatially compact nodes.
+    See: Leutenegger, Lopez & Edgington (1997), STR: A Simple and Efficient Algorithm for R-Tree Packing.
+    '''
+    import numpy as np
+    count = len(bboxes)
+    if not count:
+        return np.zeros(0, dtype=np.int64)
+    xcenters = (bboxes[:,0] + bboxes[:,2]) / 2.0
+    ycenters = (bboxes[:,1] + bboxes[:,3]) / 2.0
+    # sort by x and cut into vertical slices of about sqrt(leafnodes) nodes each
+    leaves = int(math.ceil(count / float(capacity)))
+    slices = int(math.ceil(math.sqrt(leaves)))
+    slicesize = slices * capacity
+    order = np.argsort(xcenters, kind='mergesort')
+    # then sort each slice by y
+    for start in range(0, count, slicesize):
+        sliceorder = order[start:start+slicesize]
+        order[start:start+slicesize] = sliceorder[np.argsort(ycenters[sliceorder], kind='mergesort')]
+    return order
+
+class PyramidIndex(object):
+    '''Overview pyramid of a raster field, so that zoomed out reads don't have to
+    decode every full resolution tile. Each level halves the resolution of the one
+    below it (or divides it by factor), and is built from that level by merging
+    each group of factor x factor tiles into one downsampled tile, so all levels
+    have about the same tile size in pixels. Levels are stored as sibling tables
+    and registered in the raster_overviews metatable.
+    Tiles are assumed to be cut from a north up grid, as done by import_raster.
+    See: Li et al. (2016), An Efficient Tile-Pyramids Building Method for Fast Visualization
+    of Massive Geospatial Raster Datasets.
+    '''
+    def __init__(self, workspace, table, field='rast'):
+        self.workspace = workspace
+        self.table = table
+        self.field = field
+        self.backend = _PyramidTableBackend(workspace, table, field)
+
+    def __repr__(self):
+        return '<PyramidIndex: table="{}" field="{}" levels={}>'.format(self.table, self.field, len(self.levels()))
+
+    def levels(self):
+        '''List of (factor, table name, xres, yres) of each overview level, from finest to coarsest,
+        where factor is the total downsampling relative to the table.
+        '''
+        if 'raster_overviews' not in self.workspace.metatablenames:
+            return []
+        rows = self.workspace._fetchall('''SELECT factor, ovtbl, xres, yres FROM raster_overviews
+                                          WHERE tbl = ? AND col = ? ORDER BY factor''', (self.table, self.field))
+        return [tuple(row) for row in rows]
+
+    def level(self, resolution):
+        '''Name of the table with the coarsest level whose cell size is no larger than the requested
+        resolution, in the units of the raster coordinates. Defaults to the table itself.
+        '''
+        name = self.table
+        for factor,ovtbl,xres,yres in self.levels():
+            # allow for rounding errors in the cell sizes
+            if max(xres, yres) <= resolution * (1 + 1e-9):
+                name = ovtbl
+        return name
+
+    def build(self, levels=None, resampling='mean', factor=2, verbose=True):
+        '''Builds the overview levels, each from the one below it.
+        levels is the number of levels, or None to continue until a level fits in a single tile.
+        resampling is either 'mean', 'mode' or 'nearest', or a list with one for each band.
+        '''
+        self.drop()
+        if isinstance(resampling, basestring):
+            resamplingstring = resampling
+        else:
+            resamplingstring = ','.join(resampling)
+
+        source = self.table
+        total = 1
+        level = 0
+        while levels is None or level < levels:
+            # tile positions from the bbox stored in each tile header, without decoding the tiles
+            rows = self.workspace._fetchall('''SELECT oid, rt_xmin({f}), rt_ymin({f}), rt_xmax({f}), rt_ymax({f})
+                                              FROM {t} WHERE {f} IS NOT NULL'''.format(f=self.field, t=source))
+            if len(rows) <= 1:
+                break
+            grid = TileGridIndex(self.workspace, source, self.field).grid()
+            if grid:
+                # tiles that only contained nodata may not have been stored, so the
+                # extent and tile size must come from the grid rather than the tiles
+                (xscale,_,x0,_,yscale,y0),(tw,th),(w,h) = grid
+                x1,y1 = x0 + w * xscale, y0 + h * yscale
+                tilewidth,tileheight = tw * abs(xscale), th * abs(yscale)
+            else:
+                (wkb,), = self.workspace._fetchall('SELECT CAST({} AS BLOB) FROM {} WHERE oid = ?'.format(self.field, source), (rows[0][0],))
+                xscale,_,_,_,yscale,_ = _header_affine(wkb)
+                x0 = min(row[1] for row in rows)
+                y0 = max(row[4] for row in rows)
+                x1 = max(row[3] for row in rows)
+                y1 = min(row[2] for row in rows)
+                tilewidth = max(row[3] - row[1] for row in rows)
+                tileheight = max(row[4] - row[2] for row in rows)
+            groups = {}
+            for oid,xmin,ymin,xmax,ymax in rows:
+                col = int(round((xmin - x0) / tilewidth))
+                row = int(round((y0 - ymax) / tileheight))
+                groups.setdefault((row // factor, col // factor), []).append((oid, row % factor, col % factor))
+            # size of full tiles in pixels
+            tilesize = int(round(tilewidth / abs(xscale))), int(round(tileheight / abs(yscale)))
+            # size of the source in pixels, so that groups with missing tiles are still merged to full size
+            srcsize = int(round((x1 - x0) / abs(xscale))), int(round((y0 - y1) / abs(yscale)))
+
+            total *= factor
+            level += 1
+            ovtable = self.backend.create_level(total)
+
+            tiles = ((self._merge(source, groups[key], key, tilesize, srcsize, factor, resampling),) + key
+                     for key in sorted(groups))
+            if verbose:
+                tiles = track_progress(tiles, 'Building overview level {} of field "{}" on table "{}"'.format(level, self.field, self.table), total=len(groups))
+            self.workspace.begin()
+            ovtable.add_rows(tiles)
+            self.workspace.commit()
+
+            # the group keys are the tile positions of the new level
+            xres,yres = abs(xscale) * factor, abs(yscale) * factor
+            affine = [xscale * factor, 0, x0, 0, yscale * factor, y0]
+            size = (int(math.ceil(round((x1 - x0) / xres, 6))), int(math.ceil(round((y0 - y1) / yres, 6))))
+            gridsize = -(-size[0] // tilesize[0]) * -(-size[1] // tilesize[1])
+            self.backend.index_level(ovtable, affine, tilesize, size, skipped=gridsize - len(groups))
+            self.workspace._fetchall('''INSERT INTO raster_overviews (tbl, col, factor, ovtbl, xres, yres, resampling)
+                                        VALUES (?,?,?,?,?,?,?)''', (self.table, self.field, total, ovtable.name, xres, yres, resamplingstring))
+            source = ovtable.name
+
+    def _merge(self, source, group, key, tilesize, srcsize, factor, resampling):
+        # merges a group of (oid, row, col) tiles into one downsampled tile
+        # key is the (row, col) of the group, and srcsize the (width, height) of the source in pixels
+        import numpy as np
+        from .raster.data import Raster
+        from .raster.resample import downsample
+        from .raster.serialize import from_wkb_buffer
+        oids = [oid for oid,_,_ in group]
+        query = 'SELECT oid, CAST({} AS BLOB) FROM {} WHERE oid IN ({})'.format(self.field, source, ','.join('?'*len(oids)))
+        tiles = dict((oid, from_wkb_buffer(wkb)) for oid,wkb in self.workspace._fetchall(query, oids))
+        positions = dict((oid, (row, col)) for oid,row,col in group)
+
+        tw,th = tilesize
+        width = min(factor * tw, srcsize[0] - key[1] * factor * tw)
+        height = min(factor * th, srcsize[1] - key[0] * factor * th)
+
+        # upper left corner of the group, from any of its tiles
+        oid = oids[0]
+        row,col = positions[oid]
+        affine = tiles[oid].affine
+        xoff = affine.c - col * tw * affine.a
+        yoff = affine.f - row * th * affine.e
+        merged = Raster(None, -(-width // factor), -(-height // factor),
+                        [affine.a * factor, affine.b, xoff, affine.d, affine.e * factor, yoff])
+        # constant tiles don't record their compression, so use any that does
+        merged.compression = next((tile.compression for tile in tiles.values() if tile.compression), None)
+
+        for i,band in enumerate(tiles[oid].bands):
+            data = np.zeros((height, width), dtype=band.dtype)
+            valid = np.zeros((height, width), dtype=bool)
+            for oid in oids:
+                row,col = positions[oid]
+                tile = tiles[oid]
+                y,x = row * th, col * tw
+                data[y:y+tile.height, x:x+tile.width] = tile.bands[i].data()
+                valid[y:y+tile.height, x:x+tile.width] = True
+            method = resampling if isinstance(resampling, basestring) else resampling[i]
+            out = downsample(data, factor, method, nodataval=band.nodataval, valid=valid)
+            merged.add_band(out, out.dtype, out.shape[1], out.shape[0], nodataval=band.nodataval)
+        return merged
+
+    def drop(self):
+        for factor,ovtbl,xres,yres in self.levels():
+            self.backend.drop_level(ovtbl)
+        if 'raster_overviews' in self.workspace.metatablenames:
+            self.workspace._fetchall('DELETE FROM raster_overviews WHERE tbl = ? AND col = ?', (self.table, self.field))
+
+def _header_affine(wkb):
+    # affine coefficients of a wkb raster, read from the header
+    (endian,) = unpack_from('<b', wkb, 0)
+    endian = '<' if endian == 1 else '>'
+    scaleX, scaleY, ipX, ipY, skewX, skewY = unpack_from(endian + 'dddddd', wkb, 5)
+    return [scaleX, skewX, ipX, skewY, scaleY, ipY]
 
 # Backends
 
@@ -43,9 +486,30 @@ class QuadTreeIndex:
 class _PyqtreeBackend:
     pass
 
-class _PyramidTableBackend:
+class _PyramidTableBackend(object):
+    # stores each pyramid level as a sibling table with a single raster field, named after the table,
+    # field and total downsampling factor, with its own tile grid for bbox queries
     # see https://www.researchgate.net/publication/311423420_An_Efficient_Tile-Pyramids_Building_Method_for_Fast_Visualization_of_Massive_Geospatial_Raster_Datasets
-    pass
+    prefix = '_pyramid_'
+
+    def __init__(self, workspace, table, field):
+        self.workspace = workspace
+        self.table = table
+        self.field = field
+
+    def name(self, factor):
+        return '{}{}_{}_{}'.format(self.prefix, self.table.replace('.','_'), self.field, factor)
+
+    def create_level(self, factor):
+        fields = [(self.field, 'rast'), ('tile_row', 'int'), ('tile_col', 'int')]
+        return self.workspace.new_table(self.name(factor), fields, replace=True)
+
+    def index_level(self, table, affine, tilesize, size, skipped=0):
+        TileGridIndex(self.workspace, table.name, self.field).create(affine, tilesize, size, skipped)
+
+    def drop_level(self, name):
+        TileGridIndex(self.workspace, name, self.field).drop()
+        self.workspace._fetchall('DROP TABLE IF EXISTS {}'.format(name))
 
 
 
@@ -1,15 +1,72 @@
 
 import sqlite3
 import math
+import json
 
 from shapely.ops import unary_union
 from shapely.geometry import Point
+from shapely.prepared import prep
+from collections import OrderedDict
 
-from .vector.serialize import from_wkb, shapely_to_wkb
+from .vector.serialize import from_wkb, shapely_to_wkb, wkb_bounds
+from .vector import geography
+from .vector import serialize
+from .raster.serialize import wkb_bounds as rast_wkb_bounds
+from .raster.serialize import from_wkb_buffer as rast_from_wkb
+from .raster.zonal import ZonalStats
 
 # REMEMBER: All functions take the raw sqlite type, ie blob, so must convert, and then convert back to raw blob again before returning
 
 
+class GeometryCache(object):
+    '''Bounded LRU cache of parsed geometries, keyed by their raw wkb bytes.
+    In a query like "st_intersects(a.geom, b.geom) FROM a JOIN b" the same a.geom
+    is passed once for every row of b, so it only needs to be parsed once.
+    Geometries that are seen more than once are also prepared, for faster predicates.
+    Memory is bounded by maxbytes, counting each wkb twice to roughly account for the geometry.
+    '''
+    def __init__(self, maxbytes=64*1024*1024):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.items = OrderedDict() # wkb -> [geom, prepared]
+
+    def _entry(self, wkb):
+        key = bytes(wkb)
+        entry = self.items.pop(key, None)
+        if entry is None:
+            entry = [from_wkb(key), None]
+            self.nbytes += len(key) * 2
+            while self.nbytes > self.maxbytes and self.items:
+                oldkey,_ = self.items.popitem(last=False)
+                self.nbytes -= len(oldkey) * 2
+        # put last, as the most recently used
+        self.items[key] = entry
+        return entry
+
+    def geometry(self, wkb):
+        return self._entry(wkb)[0]
+
+    def prepared(self, wkb):
+        # returns the prepared geometry if seen before, otherwise the plain geometry
+        entry = self._entry(wkb)
+        if entry[1] is None:
+            entry[1] = False
+            return entry[0]
+        elif entry[1] is False:
+            entry[1] = prep(entry[0])
+        return entry[1]
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+# shared by all the functions below, and cleared by the workspace after each statement
+geometry_cache = GeometryCache()
+
+def clear_cache():
+    geometry_cache.clear()
+
+
 
 def register_funcs(db):
     # funcs
@@ -17,47 +74,115 @@ def register_funcs(db):
     
     db.create_function("st_intersects", 2, intersects)
     db.create_function("st_disjoint", 2, disjoint)
+    db.create_function("st_contains", 2, contains)
+    db.create_function("st_within", 2, within)
+    db.create_function("st_covers", 2, covers)
+    db.create_function("st_touches", 2, touches)
+    db.create_function("st_crosses", 2, crosses)
+    db.create_function("st_overlaps", 2, overlaps)
     
     db.create_function("st_intersection", 2, intersection)
     db.create_function("st_union", 2, union)
     db.create_function("st_difference", 2, difference)
 
     db.create_function("st_area", 1, area)
+    db.create_function("st_length", 1, length)
+    db.create_function("st_buffer", 2, buffer)
+
+    db.create_function("st_encode", 4, encode)
+
+    db.create_function("st_geodesic_area", 1, geodesic_area)
+    db.create_function("st_geodesic_length", 1, geodesic_length)
+
+    db.create_function("st_xmin", 1, xmin)
+    db.create_function("st_ymin", 1, ymin)
+    db.create_function("st_xmax", 1, xmax)
+    db.create_function("st_ymax", 1, ymax)
+
+    db.create_function("rt_xmin", 1, rast_xmin)
+    db.create_function("rt_ymin", 1, rast_ymin)
+    db.create_function("rt_xmax", 1, rast_xmax)
+    db.create_function("rt_ymax", 1, rast_ymax)
 
     # aggregates
     db.create_aggregate("st_union", 1, UnionAgg)
+    db.create_aggregate("rt_zonalstats", 2, ZonalStatsAgg)
+    db.create_aggregate("rt_zonalstats", 3, ZonalStatsAgg)
+    db.create_aggregate("rt_zonalstats", 4, ZonalStatsAgg)
 
 
 ###
 
+def encode(obj, codec, precision, compression):
+    # re-encode a geometry, see Table.set_geometry_codec
+    if obj is None:
+        return None
+    obj = geometry_cache.geometry(obj)
+    return serialize.encode(obj, codec, precision, compression)
+
 def makepoint(x, y):
     p = Point(x, y)
     wkb = shapely_to_wkb(p)
     return wkb
 
 
+def _bboxes_disjoint(obj, other):
+    # compare the bboxes stored in the wkb headers, without parsing the geometries
+    # empty geometries have no bbox and are always disjoint
+    bbox = wkb_bounds(obj)
+    otherbbox = wkb_bounds(other)
+    if bbox is None or otherbbox is None:
+        return True
+    xmin,ymin,xmax,ymax = bbox
+    oxmin,oymin,oxmax,oymax = otherbbox
+    return xmax < oxmin or xmin > oxmax or ymax < oymin or ymin > oymax
+
 def intersects(obj, other):
     # assert is shapely...
     if obj is None or other is None:
         return None
-    obj = from_wkb(obj)
-    other = from_wkb(other)
+    if _bboxes_disjoint(obj, other):
+        return False
+    obj = geometry_cache.prepared(obj)
+    other = geometry_cache.geometry(other)
     return obj.intersects(other)
 
 def disjoint(obj, other):
     # assert is shapely...
     if obj is None or other is None:
         return None
-    obj = from_wkb(obj)
-    other = from_wkb(other)
+    if _bboxes_disjoint(obj, other):
+        return True
+    obj = geometry_cache.prepared(obj)
+    other = geometry_cache.geometry(other)
     return obj.disjoint(other)
 
+def _predicate(name):
+    # predicates that can only be true if the bboxes intersect
+    def predicate(obj, other):
+        if obj is None or other is None:
+            return None
+        if _bboxes_disjoint(obj, other):
+            return False
+        obj = geometry_cache.prepared(obj)
+        other = geometry_cache.geometry(other)
+        return getattr(obj, name)(other)
+    predicate.__name__ = name
+    return predicate
+
+contains = _predicate('contains')
+within = _predicate('within')
+covers = _predicate('covers')
+touches = _predicate('touches')
+crosses = _predicate('crosses')
+overlaps = _predicate('overlaps')
+
 def intersection(obj, other):
     # assert is shapely...
     if obj is None or other is None:
         return None
-    obj = from_wkb(obj)
-    other = from_wkb(other)
+    obj = geometry_cache.geometry(obj)
+    other = geometry_cache.geometry(other)
     res = obj.intersection(other)
     wkb = shapely_to_wkb(res)
     return wkb
@@ -66,8 +191,8 @@ def union(obj, other):
     # assert is shapely...
     if obj is None or other is None:
         return None
-    obj = from_wkb(obj)
-    other = from_wkb(other)
+    obj = geometry_cache.geometry(obj)
+    other = geometry_cache.geometry(other)
     res = obj.union(other)
     wkb = shapely_to_wkb(res)
     return wkb
@@ -76,35 +201,110 @@ def difference(obj, other):
     # assert is shapely...
     if obj is None or other is None:
         return None
-    obj = from_wkb(obj)
-    other = from_wkb(other)
+    obj = geometry_cache.geometry(obj)
+    other = geometry_cache.geometry(other)
     res = obj.difference(other)
     wkb = shapely_to_wkb(res)
     return wkb
 
 
 
+def buffer(obj, dist):
+    if obj is None or dist is None:
+        return None
+    obj = geometry_cache.geometry(obj)
+    res = obj.buffer(dist)
+    wkb = shapely_to_wkb(res)
+    return wkb
+
+
+
 def area(obj):
     # assert is shapely or geography...
     if obj is None:
         return None
+    obj = geometry_cache.geometry(obj)
     return obj.area
+
+def length(obj):
+    if obj is None:
+        return None
+    obj = geometry_cache.geometry(obj)
+    return obj.length
+
+def geodesic_area(obj):
+    # square meters, for lon/lat geometries
+    if obj is None:
+        return None
+    obj = geometry_cache.geometry(obj)
+    return geography.geodesic_area(obj)
+
+def geodesic_length(obj):
+    # meters, for lon/lat geometries
+    if obj is None:
+        return None
+    obj = geometry_cache.geometry(obj)
+    return geography.geodesic_length(obj)
+
+
+
+# bbox functions, eg for maintaining spatial indexes
+# these only read the bbox stored in the geom or rast header, without parsing the full blob
+
+def _bounds_getter(bounds, i):
+    def getter(wkb):
+        if wkb is None:
+            return None
+        bbox = bounds(wkb)
+        if bbox:
+            return bbox[i]
+    return getter
+
+xmin = _bounds_getter(wkb_bounds, 0)
+ymin = _bounds_getter(wkb_bounds, 1)
+xmax = _bounds_getter(wkb_bounds, 2)
+ymax = _bounds_getter(wkb_bounds, 3)
+
+rast_xmin = _bounds_getter(rast_wkb_bounds, 0)
+rast_ymin = _bounds_getter(rast_wkb_bounds, 1)
+rast_xmax = _bounds_getter(rast_wkb_bounds, 2)
+rast_ymax = _bounds_getter(rast_wkb_bounds, 3)
     
 
 ###
 
 class UnionAgg:
+    '''Union aggregate that never holds more than batchsize input geometries in memory.
+    Each full batch is unioned into a partial result, and partial results are merged
+    pairwise like a binary counter, so each geometry takes part in about log(n) unions
+    and only a logarithmic number of partial results are kept at any time.
+    '''
+    # number of geometries to collect before unioning them, can be changed to trade memory for speed
+    batchsize = 1000
+    
     def __init__(self):
         self.geoms = []
+        self.partials = [] # (level, geom) pairs, with decreasing levels
+
+    def _merge(self, geom, level=0):
+        # merge with any partial of the same level, which cascades upwards
+        while self.partials and self.partials[-1][0] == level:
+            _, other = self.partials.pop()
+            geom = unary_union([other, geom])
+            level += 1
+        self.partials.append((level, geom))
 
     def step(self, wkb):
-        # TODO: do cascaded union for every X items, to avoid memory overload
         try:
             if wkb is None:
                 return None
 
             g = from_wkb(wkb)
             self.geoms.append(g)
+
+            if len(self.geoms) >= self.batchsize:
+                self._merge(unary_union(self.geoms))
+                self.geoms = []
             
         except Exception as EXStep:
             pass
@@ -112,7 +312,8 @@ class UnionAgg:
 
     def finalize(self):
         try:
-            union = unary_union(self.geoms)
+            geoms = [g for _,g in self.partials] + self.geoms
+            union = unary_union(geoms)
             #print str(union)[:100]
             wkb = shapely_to_wkb(union)
             #print str(wkb)[:100]
@@ -121,5 +322,25 @@ class UnionAgg:
             pass
             return None
 
+class ZonalStatsAgg:
+    '''Zonal statistics aggregate, rt_zonalstats(rast, geom [, band [, bins]]), over the raster
+    tiles and polygon of a zone, eg grouped by the polygon in a join of the tiles that intersect it.
+    Returns a json object of the count, sum, mean, min, max and histogram, see raster.zonal.ZonalStats.
+    band is 0-based, and bins a json list of histogram bin edges.
+    Each tile is only decoded while it is being added, so memory stays bounded.
+    '''
+    def __init__(self):
+        self.stats = None
 
+    def step(self, rast, geom, band=0, bins=None):
+        if rast is None or geom is None:
+            return
+        if self.stats is None:
+            self.stats = ZonalStats(band, json.loads(bins) if bins else None)
+        geom = geometry_cache.geometry(geom)
+        self.stats.add(geom, rast_from_wkb(rast))
 
+    def finalize(self):
+        if self.stats is None:
+            self.stats = ZonalStats()
+        return json.dumps(self.stats.result())
@@ -3,5 +3,7 @@ from . import load
 from . import fileformats
 from . import serialize
 from . import data
+from . import resample
+from . import zonal
 
 
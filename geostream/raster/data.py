@@ -1,4 +1,5 @@
 
+import os
 import numpy as np
 import math
 
@@ -8,8 +9,16 @@ from .load import file_reader
 
 from wkb_raster import write_wkb_raster
 
+# file readers of offline bands, opened once per path
+_readers = {}
+
+def _offline_reader(path):
+    if path not in _readers:
+        _readers[path] = file_reader(path)
+    return _readers[path]
+
 class Band(object):
-    def __init__(self, rast, data=None, dtype=None, width=None, height=None, initialvalue=0, nodataval=None):
+    def __init__(self, rast, data=None, dtype=None, width=None, height=None, initialvalue=0, nodataval=None, path=None, bandnum=None):
         self.rast = rast
         # data is either None or np.array
         self._data = data
@@ -18,6 +27,10 @@ class Band(object):
         self.height = height
         self.initialvalue = initialvalue
         self.nodataval = nodataval
+        # offline bands refer to band number bandnum (0-based) of the file at path,
+        # at the position of the raster they belong to, and only read the pixels when needed
+        self.path = path
+        self.bandnum = bandnum
 
     def __repr__(self):
         return "<Band object: dtype={dtype} size={size} nodataval={nodataval}>".format(dtype=self.dtype,
@@ -25,52 +38,93 @@ class Band(object):
                                                                                        nodataval=self.nodataval)
     
 
+    @property
+    def offline(self):
+        return self.path is not None or bool(self.rast and self.rast.filepath)
+
+    def _offline_source(self):
+        # the file path, band number and pixel offset of the band within the file
+        if self.path:
+            reader = _offline_reader(self.path)
+            # offset is the position of the raster's upper-left corner within the file
+            fileaffine = Affine(*reader.affine)
+            px,py = ~fileaffine * (self.rast.affine.c, self.rast.affine.f)
+            return reader, self.bandnum, (int(round(px)), int(round(py)))
+        else:
+            return self.rast.reader, self.rast.bands.index(self), (0, 0)
+
     def data(self, bbox=None):        
         # if file source, use the reader to return the data, but do not store the data in memory
-        if self.rast and self.rast.filepath:
-            bandnum = self.rast.bands.index(self)
-            data = self.rast.reader.data(bandnum, bbox)
+        if self.offline:
+            reader,bandnum,(xoff,yoff) = self._offline_source()
+            x1,y1,x2,y2 = bbox or (0, 0, self.width, self.height)
+            x2, y2 = min(x2, self.width), min(y2, self.height)
+            data = reader.data(bandnum, [xoff+x1, yoff+y1, xoff+x2, yoff+y2])
 
         else:
             # create empty data if not exists
             data = self._data
             if data is None:
-                data = np.full((self.width,self.height), initialvalue, dtype=dtype)
+                data = np.full((self.height,self.width), self.initialvalue, dtype=self.dtype)
                 self._data = data
 
             # crop to bbox
             if bbox:
                 x1,y1,x2,y2 = bbox
-                x2, y2 = min(x12, self.width), min(y2, self.height)
+                x2, y2 = min(x2, self.width), min(y2, self.height)
                 w,h = x2-x1, y2-y1
                 data = data[y1:y2, x1:x2]
 
         return data
 
-    def crop(self, bbox):
+    def is_nodata(self):
+        # whether all pixels are nodata
+        if self.nodataval is None:
+            return False
+        return bool(np.all(self.data() == self.nodataval))
+
+    def crop(self, bbox, offline=False):
+        if offline:
+            # only keep a reference to the pixels in the file
+            if not self.offline:
+                raise Exception('Only bands read from a file can be cropped as offline bands')
+            x1,y1,x2,y2 = bbox
+            w, h = min(x2, self.width) - x1, min(y2, self.height) - y1
+            if self.path:
+                path,bandnum = self.path,self.bandnum
+            else:
+                path,bandnum = os.path.abspath(self.rast.filepath),self.rast.bands.index(self)
+            return Band(None, None, self.dtype, w, h, nodataval=self.nodataval, path=path, bandnum=bandnum)
         data = self.data(bbox)
         w, h = data.shape[1], data.shape[0]
-        band = Band(None, data, data.dtype, w, h, self.nodataval)
+        band = Band(None, data, data.dtype, w, h, nodataval=self.nodataval)
         return band
 
     def wkb_dict(self):
-        data = self.data() # force loading the data
         dtypes = ['bool', None, None, 'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float32', 'float64']
-        pixtype = dtypes.index(str(self.dtype))
+        # by name, since decoded tiles keep the byte order of the blob, eg >u2
+        pixtype = dtypes.index(np.dtype(self.dtype).name)
                                
-        dct = {'isOffline': self.rast and bool(self.rast.filepath),
+        dct = {'isOffline': self.offline,
                'hasNodataValue': self.nodataval is not None,
-               'isNodataValue': np.all(self.data == self.nodataval),
-               'ndarray': data,
+               'isNodataValue': False,
                'pixtype': pixtype,
                }
 
         dct['nodata'] = self.nodataval if dct['hasNodataValue'] else 0
         
         if dct['isOffline']:
-            bandnum = self.rast.bands.index(self)
-            dct['bandNumber'] = bandnum
-            dct['path'] = self.rast.filepath
+            # only the reference, the pixels are not loaded
+            if self.path:
+                path,bandnum = self.path,self.bandnum
+            else:
+                path,bandnum = os.path.abspath(self.rast.filepath),self.rast.bands.index(self)
+            dct['bandNumber'] = bandnum + 1 # 1-based
+            dct['path'] = path
+        else:
+            data = self.data() # force loading the data
+            dct['ndarray'] = data
+            dct['isNodataValue'] = self.is_nodata()
             
         return dct
 
@@ -86,7 +140,8 @@ class Raster(object):
             affine = affine or self.reader.affine
             for i in range(self.reader.bandcount):
                 nodataval = self.reader.nodata(i)
-                self.add_band(nodataval=nodataval)
+                dtype = self.reader.dtype(i)
+                self.add_band(dtype=dtype, width=width, height=height, nodataval=nodataval)
         else:
             self.reader = None
         
@@ -94,6 +149,8 @@ class Raster(object):
         self.height = height
         self.affine = Affine(*affine)
         self.kwargs = kwargs
+        # compression of the band pixels when serialized, either None, 'zlib' or 'lz4'
+        self.compression = None
 
     def __repr__(self):
         return "<Raster data: dtype={dtype} bands={bands} size={size} bbox={bbox}>".format(dtype=None, #self.dtype,
@@ -124,48 +181,60 @@ class Raster(object):
     def band(self, i):
         return self.bands[i]
 
+    def is_nodata(self):
+        # whether all pixels of all bands are nodata
+        return bool(self.bands) and all(band.is_nodata() for band in self.bands)
+
     def add_band(self, *args, **kwargs):
         if args and isinstance(args[0], Band):
             band = args[0]
+            band.rast = self
         else:
             band = Band(self, *args, **kwargs)
         self.bands.append(band)
 
-    def tiled(self, tilesize=None, tiles=None):
+    def tiled(self, tilesize=None, tiles=None, offline=False):
         # create iterable tiler class, to allow also checking length
         
         class Tiler:
-            def __init__(self, rast, tilesize=None, tiles=None):
+            def __init__(self, rast, tilesize=None, tiles=None, offline=False):
                 self.rast = rast
+                self.offline = offline
                 
                 # determine tile sizes
                 if not (tilesize or tiles):
                     tilesize = (200,200)
                 if tiles:
-                    xtiles,ytiles = list(map(float, (xtiles,ytiles)))
-                    tilesize = int(self.rast.width/xtiles)+1, int(self.rast.height/ytiles)+1
+                    xtiles,ytiles = list(map(float, tiles))
+                    tilesize = int(math.ceil(self.rast.width/xtiles)), int(math.ceil(self.rast.height/ytiles))
 
                 self.tilesize = tilesize
-                
-            def __iter__(self):
+
+            def windows(self):
+                # pixel bbox of each tile, row by row, clipped to the raster
                 tw,th = self.tilesize
                 for y in range(0, self.rast.height, th):
                     for x in range(0, self.rast.width, tw):
-                        tile = self.rast.crop([x, y, x+tw, y+th], worldcoords=False)
-                        yield tile
+                        yield [x, y, min(x+tw, self.rast.width), min(y+th, self.rast.height)]
+                
+            def __iter__(self):
+                for window in self.windows():
+                    tile = self.rast.crop(window, worldcoords=False, offline=self.offline)
+                    yield tile
                         
             def __len__(self):
                 return self.tilenum()
 
             def tilenum(self):
                 tw,th = list(map(float, self.tilesize))
-                tiles = (int(self.rast.width/tw)+1, int(self.rast.height/th))
+                tiles = (int(math.ceil(self.rast.width/tw)), int(math.ceil(self.rast.height/th)))
                 tilenum = tiles[0] * tiles[1]
                 return tilenum
 
-        return Tiler(self, tilesize=tilesize, tiles=tiles)
+        return Tiler(self, tilesize=tilesize, tiles=tiles, offline=offline)
 
-    def crop(self, bbox, worldcoords=True):
+    def crop(self, bbox, worldcoords=True, offline=False):
+        # with offline=True, the bands of file rasters only refer to the cropped pixels in the file
         if worldcoords:
             x1,y1,x2,y2 = bbox
             px1,py1 = self.geo_to_cell(x1, y1)
@@ -173,8 +242,6 @@ class Raster(object):
         else:
             px1,py1,px2,py2 = bbox
 
-        print bbox, '-->', [px1,py1,px2,py2]
-
         # do bounds check
         pxmin = min(px1,px2)
         pymin = min(py1,py2)
@@ -204,13 +271,15 @@ class Raster(object):
         
         rast = Raster(None, pw, ph, [xscale,xskew,xoff,yskew,yscale,yoff])
         for band in self.bands:
-            cropped_band = band.crop([px1, py1, px2, py2])
+            cropped_band = band.crop([px1, py1, px2, py2], offline=offline)
             rast.add_band(cropped_band)
         return rast 
 
     @property
     def wkb(self):
         band_dicts = [b.wkb_dict() for b in self.bands]
+        for dct in band_dicts:
+            dct['compression'] = self.compression
         wkb = write_wkb_raster(band_dicts,
                                self.width,
                                self.height,
@@ -37,6 +37,14 @@ class GDALRaster(object):
             arrdata = band.ReadAsArray(0, 0, self.width, self.height)
         return arrdata
 
+    def dtype(self, band):
+        band += 1 # gdal band is 1-based
+        band = self.reader.GetRasterBand(band)
+        typename = gdal.GetDataTypeName(band.DataType)
+        return {'Byte':'uint8', 'UInt16':'uint16', 'Int16':'int16',
+                'UInt32':'uint32', 'Int32':'int32',
+                'Float32':'float32', 'Float64':'float64'}[typename]
+
     def nodata(self, band):
         band += 1 # gdal band is 1-based
         band = self.reader.GetRasterBand(band)
@@ -1,6 +1,9 @@
 
 import sys
+import zlib
+from collections import OrderedDict
 
+import numpy as np
 import PIL, PIL.Image
 
 
@@ -8,20 +11,92 @@ PIL.Image.MAX_IMAGE_PIXELS = sys.maxsize
 
 
 def pilmode_to_dtype(mode):
-    dtyp = {"1":"int8",
+    # dtype of each band
+    dtyp = {"1":"bool",
             
-            "L":"int8",
-            "P":"int8",
+            "L":"uint8",
+            "P":"uint8",
+            "LA":"uint8",
+            "RGB":"uint8",
+            "RGBA":"uint8",
+            "CMYK":"uint8",
             
-            "I;16":"int16",
+            "I;16":"uint16",
+            "I;16B":"uint16",
+            "I;16S":"int16",
+            "I;16BS":"int16",
             "I":"int32",
             
-            "F;16":"float16",
             "F":"float32"}[mode]
     
     return dtyp
 
 
+# block decompressors by tiff compression tag
+
+def _unpackbits(data):
+    data = bytearray(data)
+    out = bytearray()
+    i,n = 0,len(data)
+    while i < n:
+        header = data[i]
+        i += 1
+        if header < 128:
+            # literal run
+            out += data[i:i+header+1]
+            i += header + 1
+        elif header > 128:
+            # repeated byte
+            out += data[i:i+1] * (257 - header)
+            i += 1
+    return bytes(out)
+
+def _unlzw(data):
+    # tiff flavor of lzw: msb first codes of 9 to 12 bits, with the code width
+    # increased one code early, 256 clears the table and 257 ends the data
+    data = bytearray(data) + bytearray(3)
+    nbits = (len(data) - 3) * 8
+    out = bytearray()
+    table = [bytes(bytearray([i])) for i in range(256)] + [None, None]
+    width = 9
+    pos = 0
+    prev = None
+    while pos + width <= nbits:
+        byte = pos >> 3
+        chunk = (data[byte] << 16) | (data[byte+1] << 8) | data[byte+2]
+        code = (chunk >> (24 - (pos & 7) - width)) & ((1 << width) - 1)
+        pos += width
+        if code == 256:
+            del table[258:]
+            width = 9
+            prev = None
+            continue
+        elif code == 257:
+            break
+        if prev is None:
+            entry = table[code]
+        elif code < len(table):
+            entry = table[code]
+            table.append(prev + entry[:1])
+        else:
+            entry = prev + prev[:1]
+            table.append(entry)
+        out += entry
+        prev = entry
+        if len(table) + 1 >= (1 << width) and width < 12:
+            width += 1
+    return bytes(out)
+
+DECOMPRESSORS = {1: None,
+                 5: _unlzw,
+                 8: zlib.decompress,
+                 32946: zlib.decompress,
+                 32773: _unpackbits}
+
+# numpy kind by tiff sampleformat tag
+SAMPLEFORMATS = {1:'u', 2:'i', 3:'f'}
+
+
 class GeoTIFF(object):
     def __init__(self, filepath, **kwargs):
         self.filepath = filepath
@@ -36,32 +111,155 @@ class GeoTIFF(object):
         self.crs = self.load_crs()
         self.meta = self.load_meta()
 
+        # windowed reads
+        with open(self.filepath, 'rb') as fobj:
+            self._byteorder = fobj.read(2)
+        self.layout = self.load_layout()
+        self.blockcache = kwargs.get('blockcache', 16)
+        self._blocks = OrderedDict()
+        self._file = None
+
     def data(self, band, bbox=None):
-        if bbox:
-            tiletype, extent, fileoffset, args = self.reader.tile[0]
-            if 1: #tiletype == 'raw':
-                x1,y1,x2,y2 = bbox
-                w,h = x2-x1, y2-y1
-                newreader = self.load_reader()
-                newreader.size = (w,h)
-                lineoffset = len(self.reader.mode)*w*y1
-                newreader.tile = [(tiletype, extent, fileoffset + lineoffset + x1, args)]
-                newreader.load()
-                imgdata = self.reader.crop(bbox).split()[band]
+        '''Pixel array of a band, or only the window inside a pixel bbox [x1,y1,x2,y2].
+        Only the strips or tiles that overlap the window are read from the file and
+        decoded, so reading a small window of a huge image is cheap. Layouts that the
+        block reader doesn't support are decoded in full with PIL.
+        '''
+        if bbox is None:
+            bbox = [0, 0, self.width, self.height]
+        if self.layout:
+            return self._read_window(band, bbox)
+        else:
+            imgdata = self.reader.crop(tuple(bbox)).split()[band]
+            return np.array(imgdata)
+
+    def _read_window(self, band, bbox):
+        layout = self.layout
+        x1,y1,x2,y2 = bbox
+        # native byte order, whatever the byte order of the file
+        out = np.zeros((y2-y1, x2-x1), dtype=layout['dtype'].newbyteorder('='))
+        # clip to the image, anything outside is left as zero
+        cx1,cy1 = max(x1, 0), max(y1, 0)
+        cx2,cy2 = min(x2, self.width), min(y2, self.height)
+        if cx1 >= cx2 or cy1 >= cy2:
+            return out
+        bw,bh = layout['blockwidth'], layout['blockheight']
+        for row in range(cy1 // bh, (cy2 - 1) // bh + 1):
+            for col in range(cx1 // bw, (cx2 - 1) // bw + 1):
+                bx,by = col * bw, row * bh
+                # part of the block inside the window
+                wx1,wy1 = max(cx1, bx), max(cy1, by)
+                wx2,wy2 = min(cx2, bx + bw), min(cy2, by + bh)
+                block = self._read_block(band, row, col, wy1 - by, wy2 - by)
+                out[wy1-y1:wy2-y1, wx1-x1:wx2-x1] = block[:, wx1-bx:wx2-bx]
+        return out
+
+    def _read_block(self, band, row, col, top, bottom):
+        # rows top to bottom of a strip or tile, for a single band
+        layout = self.layout
+        index = row * layout['blocksacross'] + col
+        if layout['planar']:
+            # each band is stored in its own set of blocks
+            index += band * layout['blocksperplane']
+            sample = 0
+        else:
+            sample = band
+        if layout['compression'] == 1:
+            # uncompressed rows are read directly, no need to cache
+            pixels = self._decode_block(index, top, bottom)
+        else:
+            # keep recently decoded blocks, since neighbouring windows
+            # usually overlap the same strips or tiles
+            if index in self._blocks:
+                pixels = self._blocks.pop(index)
             else:
-                imgdata = self.reader.crop(bbox).split()[band]
+                pixels = self._decode_block(index, top, bottom)
+                while self._blocks and len(self._blocks) >= self.blockcache:
+                    self._blocks.popitem(last=False)
+            self._blocks[index] = pixels
+            pixels = pixels[top:bottom]
+        return pixels[:, :, sample]
+
+    def _decode_block(self, index, top, bottom):
+        layout = self.layout
+        samples = 1 if layout['planar'] else layout['samples']
+        bw = layout['blockwidth']
+        rowsize = bw * samples * layout['dtype'].itemsize
+        offset,bytecount = layout['offsets'][index], layout['bytecounts'][index]
+        if self._file is None:
+            self._file = open(self.filepath, 'rb')
+        if layout['compression'] == 1:
+            # uncompressed, read only the requested rows
+            self._file.seek(offset + top * rowsize)
+            raw = self._file.read((bottom - top) * rowsize)
+            rows = bottom - top
+        else:
+            self._file.seek(offset)
+            raw = DECOMPRESSORS[layout['compression']](self._file.read(bytecount))
+            # last strip may be shorter, and some encoders pad the output
+            rows = min(len(raw) // rowsize, layout['blockheight'])
+            raw = raw[:rows * rowsize]
+        pixels = np.frombuffer(raw, dtype=layout['dtype']).reshape((rows, bw, samples))
+        if layout['predictor'] == 2:
+            # horizontal differencing, undo by summing along each row
+            pixels = np.cumsum(pixels, axis=1, dtype=layout['dtype'])
+        return pixels
 
+    def load_layout(self):
+        # strip or tile layout from the tiff tags, or None if the block reader
+        # doesn't support the file, eg jpeg compression or less than 8 bit samples
+        tags = self.reader.tag
+        def tag(code, default=None):
+            val = tags.get(code)
+            return val if val is not None else default
+        compression, = tag(259, (1,))
+        predictor, = tag(317, (1,))
+        planar, = tag(284, (1,))
+        samples, = tag(277, (1,))
+        bits = set(tag(258, (1,)))
+        formats = set(tag(339, (1,)))
+        if compression not in DECOMPRESSORS or predictor not in (1,2) or len(bits) != 1 or len(formats) != 1:
+            return None
+        bits,fmt = bits.pop(),formats.pop()
+        if bits not in (8,16,32,64) or fmt not in SAMPLEFORMATS:
+            return None
+        if predictor == 2 and fmt == 3:
+            return None
+        endian = '<' if self._byteorder == b'II' else '>'
+        dtype = np.dtype('{}{}{}'.format(endian, SAMPLEFORMATS[fmt], bits // 8))
+        if 322 in tags:
+            blockwidth, = tag(322)
+            blockheight, = tag(323)
+            offsets,bytecounts = tag(324),tag(325)
         else:
-            imgdata - self.reader.split()[band]
+            blockwidth = self.width
+            blockheight, = tag(278, (self.height,))
+            blockheight = min(blockheight, self.height)
+            offsets,bytecounts = tag(273),tag(279)
+        if not offsets or not bytecounts:
+            return None
+        blocksacross = (self.width + blockwidth - 1) // blockwidth
+        blocksdown = (self.height + blockheight - 1) // blockheight
+        return dict(compression=compression, predictor=predictor, planar=planar == 2,
+                    samples=samples, dtype=dtype,
+                    blockwidth=blockwidth, blockheight=blockheight,
+                    blocksacross=blocksacross, blocksperplane=blocksacross * blocksdown,
+                    offsets=offsets, bytecounts=bytecounts)
 
-        import numpy as np
-        arrdata = np.array(imgdata)
-        return arrdata
+    def dtype(self, band):
+        # same dtype for all bands, the block reader returns native byte order
+        if self.layout:
+            return self.layout['dtype'].name
+        return pilmode_to_dtype(self.reader.mode)
 
     def nodata(self, band):
         # same nodata for all bands
         nodataval = self.reader.tag.get(42113)
+        if isinstance(nodataval, tuple):
+            # newer versions of PIL return the tag values as a tuple
+            nodataval = nodataval[0] if nodataval else None
         if nodataval:
+            nodataval = nodataval.strip('\x00 ')
             try:
                 float(nodataval) # make sure is possible to make into nr
                 nodataval = eval(nodataval) # eval from string to nr
@@ -80,7 +278,8 @@ class GeoTIFF(object):
         return self.reader.size
 
     def load_bandcount(self):
-        return len(self.reader.mode)
+        # not the length of the mode, since eg 16 bit modes are named I;16
+        return len(self.reader.getbands())
 
     def load_affine(self):
         if 1:
@@ -38,11 +38,19 @@ def from_wkb(wkb):
     rast = Raster(None, width, height, affine)
     dtypes = ['bool', None, None, 'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float32', 'float64']
     for band_dct in rast_dct['bands']:
-        data = band_dct['ndarray']
         dtype = dtypes[band_dct['pixtype']]
         width, height = rast_dct['width'], rast_dct['height']
-        nodataval = band_dct['nodata']
-        rast.add_band(data, dtype, width, height, nodataval)
+        nodataval = band_dct['nodata'] if band_dct['hasNodataValue'] else None
+        if band_dct['isOffline']:
+            # pixels are read from the file when needed
+            rast.add_band(None, dtype, width, height, nodataval=nodataval,
+                          path=band_dct['path'], bandnum=band_dct['bandNumber'] - 1)
+        else:
+            data = band_dct['ndarray']
+            rast.add_band(data, dtype, width, height, nodataval=nodataval)
+        if band_dct['compression']:
+            # so the raster is compressed the same way if written again
+            rast.compression = band_dct['compression']
     return rast
 
 
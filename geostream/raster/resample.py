@@ -0,0 +1,63 @@
+
+import numpy as np
+
+# Downsampling of band arrays by an integer factor, used to build overview levels.
+# Each output pixel summarizes a block of factor x factor input pixels, ignoring
+# pixels that are nodata or outside the data (as given by the valid mask).
+# Blocks without any valid pixels become nodata.
+
+RESAMPLINGS = ('mean', 'mode', 'nearest')
+
+def _blocks(data, factor):
+    # pads the array to a multiple of factor and returns a (rows, cols, factor*factor) view of the blocks
+    h,w = data.shape
+    ph,pw = -h % factor, -w % factor
+    if ph or pw:
+        data = np.pad(data, ((0,ph),(0,pw)), 'constant')
+    rows,cols = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data.reshape((rows, factor, cols, factor)).swapaxes(1, 2)
+    return blocks.reshape((rows, cols, factor*factor))
+
+def downsample(data, factor, method='mean', nodataval=None, valid=None):
+    '''Downsamples a 2d array by an integer factor, using the mean, the most common
+    value (mode), or the upper left value (nearest) of each block of pixels.
+    valid is an optional boolean array of which pixels have data, otherwise all
+    pixels that are not nodataval. The output has the same dtype, and the size is
+    rounded up so that partial blocks along the right and bottom edges are kept.
+    '''
+    if method not in RESAMPLINGS:
+        raise Exception('Resampling method must be one of {}, not "{}"'.format(RESAMPLINGS, method))
+    data = np.asarray(data)
+    if valid is None:
+        valid = np.ones(data.shape, dtype=bool)
+    if nodataval is not None:
+        valid = valid & (data != nodataval)
+    fill = nodataval if nodataval is not None else 0
+
+    if method == 'nearest':
+        out = data[::factor, ::factor].copy()
+        out[~valid[::factor, ::factor]] = fill
+        return out
+
+    values = _blocks(data, factor)
+    mask = _blocks(valid, factor)
+    counts = mask.sum(axis=2)
+
+    if method == 'mean':
+        sums = np.where(mask, values, 0).sum(axis=2, dtype=np.float64)
+        means = sums / np.maximum(counts, 1)
+        if np.issubdtype(data.dtype, np.integer):
+            means = np.round(means)
+        out = means.astype(data.dtype)
+
+    elif method == 'mode':
+        # for each pixel of a block, how many valid pixels in the block have the same value
+        # the most frequent is picked, and ties go to the first in the block
+        same = (values[:,:,:,None] == values[:,:,None,:]) & mask[:,:,None,:]
+        freqs = np.where(mask, same.sum(axis=3), -1)
+        first = np.argmax(freqs, axis=2)
+        rows,cols = np.indices(first.shape)
+        out = values[rows, cols, first]
+
+    out[counts == 0] = fill
+    return out
@@ -1,7 +1,7 @@
 
 import sqlite3
 from sqlite3 import Binary
-from io import BytesIO
+from struct import unpack_from
 
 from .data import Raster
 from .load import from_wkb
@@ -13,9 +13,21 @@ def rast_to_wkb(rast):
     buf = Binary(wkb)
     return buf
 
+def wkb_bounds(wkb_buf):
+    # read the raster bbox from the wkb header only, without reading any bands
+    # bbox is returned in xmin,ymin,xmax,ymax order
+    (endian,) = unpack_from('<b', wkb_buf, 0)
+    endian = '<' if endian == 1 else '>'
+    (version, bands, scaleX, scaleY, ipX, ipY, skewX, skewY,
+     srid, width, height) = unpack_from(endian + 'HHddddddIHH', wkb_buf, 1)
+    xs = [ipX + scaleX*px + skewX*py for px,py in [(0,0),(width,0),(0,height),(width,height)]]
+    ys = [ipY + skewY*px + scaleY*py for px,py in [(0,0),(width,0),(0,height),(width,height)]]
+    return min(xs), min(ys), max(xs), max(ys)
+
 def from_wkb_buffer(wkb_buf):
     # wkb buffer to raster
-    rast = from_wkb(BytesIO(bytes(wkb_buf)))
+    # the band data are read-only views over the buffer itself, so nothing is copied
+    rast = from_wkb(wkb_buf)
     return rast
 
 
@@ -1,4 +1,6 @@
-from struct import unpack, pack
+import sys
+import zlib
+from struct import unpack, unpack_from, pack, pack_into
 import numpy as np
 
 __all__ = [
@@ -30,22 +32,33 @@ def read_wkb_raster(wkb):
             'isOffline': bool,
             'hasNodataValue': bool,
             'isNodataValue': bool,
+            'isCompressed': bool,
+            'compression': None|str,
             'ndarray': numpy.ndarray((width, height), bool|int|float)
         }, ...]
     }
 
-    :wkb file-like object: Binary raster in WKB format
+    The header is read with unpack_from at offsets, and the band arrays are read-only
+    views directly over the memory of the given buffer, so no pixel data is copied.
+    Compressed bands, see _compressed_pixels(), are decompressed into new read-only arrays.
+
+    :wkb buffer or file-like object: Binary raster in WKB format
     :returns: obj
     """
     ret = {}
 
+    if hasattr(wkb, 'read'):
+        wkb = wkb.read()
+    offset = 0
+
     # Determine the endiannes of the raster
     #
     # +---------------+-------------+------------------------------+
     # | endiannes     | byte        | 1:ndr/little endian          |
     # |               |             | 0:xdr/big endian             |
     # +---------------+-------------+------------------------------+
-    (endian,) = unpack('<b', wkb.read(1))
+    (endian,) = unpack_from('<b', wkb, offset)
+    offset += 1
 
     if endian == 0:
         endian = '>'
@@ -85,7 +98,8 @@ def read_wkb_raster(wkb):
     # | height        | uint16      | number of pixel rows         |
     # +---------------+-------------+------------------------------+
     (version, bands, scaleX, scaleY, ipX, ipY, skewX, skewY,
-     srid, width, height) = unpack(endian + 'HHddddddIHH', wkb.read(60))
+     srid, width, height) = unpack_from(endian + 'HHddddddIHH', wkb, offset)
+    offset += 60
 
     ret['version'] = version
     ret['scaleX'] = scaleX
@@ -122,7 +136,9 @@ def read_wkb_raster(wkb):
         # |               |              | must be called for the band with  |
         # |               |              | 'TRUE' as last argument.          |
         # +---------------+--------------+-----------------------------------+
-        # | reserved      | 1bit         | unused in this version            |
+        # | isCompressed  | 1bit         | reserved in the postgis format,   |
+        # |               |              | here used to mark that the pixels |
+        # |               |              | are compressed, see below         |
         # +---------------+--------------+-----------------------------------+
         # | pixtype       | 4bits        | 0: 1-bit boolean                  |
         # |               |              | 1: 2-bit unsigned integer         |
@@ -139,11 +155,14 @@ def read_wkb_raster(wkb):
         #
         # Requires reading a single byte, and splitting the bits into the
         # header attributes
-        (bits,) = unpack(endian + 'b', wkb.read(1))
+        (bits,) = unpack_from(endian + 'B', wkb, offset)
+        offset += 1
 
         band['isOffline'] = bool(bits & 128)  # first bit
         band['hasNodataValue'] = bool(bits & 64)  # second bit
         band['isNodataValue'] = bool(bits & 32)  # third bit
+        band['isCompressed'] = bool(bits & 16)  # fourth bit
+        band['compression'] = None
 
         pixtype = bits & int('00001111', 2) # bits 5-8
         band['pixtype'] = pixtype
@@ -161,7 +180,8 @@ def read_wkb_raster(wkb):
         fmt = fmts[pixtype]
 
         # Read the nodata value
-        (nodata,) = unpack(endian + fmt, wkb.read(size))
+        (nodata,) = unpack_from(endian + fmt, wkb, offset)
+        offset += size
 
         band['nodata'] = nodata
 
@@ -178,18 +198,20 @@ def read_wkb_raster(wkb):
             # +-------------+-------------+-----------------------------------+
 
             # offline bands are 0-based, make 1-based for user consumption
-            (band_num,) = unpack(endian + 'B', wkb.read(1))
+            (band_num,) = unpack_from(endian + 'B', wkb, offset)
+            offset += 1
             band['bandNumber'] = band_num + 1
 
-            data = b''
-            while True:
-                byte = wkb.read(1)
-                if byte == b'\x00':
-                    break
+            # indexing a bytearray gives ints, so search a byte string instead
+            end = offset + bytes(wkb[offset:]).index(b'\x00')
 
-                data += byte
+            band['path'] = bytes(wkb[offset:end]).decode()
+            offset = end + 1
 
-            band['path'] = data.decode()
+        elif band['isCompressed']:
+            data, offset = _read_compressed_pixels(wkb, offset, endian, pixtype, width, height, band)
+            data.flags.writeable = False
+            band['ndarray'] = data
 
         else:
 
@@ -206,24 +228,133 @@ def read_wkb_raster(wkb):
             # |            |              | significant first)                |
             # |            |              |                                   |
             # +------------+--------------+-----------------------------------+
-            band['ndarray'] = np.ndarray(
-                (height, width),
-                buffer=wkb.read(width * height * size),
-                dtype=np.dtype(dtype)
-            )
+            data = np.frombuffer(wkb, dtype=np.dtype(endian + dtype),
+                                 count=width * height, offset=offset)
+            data.flags.writeable = False
+            band['ndarray'] = data.reshape((height, width))
+            offset += width * height * size
 
         ret['bands'].append(band)
 
     return ret
 
 
-# NOT SURE IF ANY OF THESE RESPECT ENDIANESS        
+# pixel type formats, used for writing
+fmts = ['?', 'B', 'B', 'b', 'B', 'h',
+        'H', 'i', 'I', 'f', 'd']
+dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
+          'u2', 'i4', 'u4', 'f4', 'f8']
+sizes = [1, 1, 1, 1, 1, 2, 2, 4, 4, 4, 8]
+
+# compression codes of compressed bands
+COMPRESSIONS = {'zlib': 1, 'lz4': 2}
+CONSTANT = 0
+SHUFFLED = 128
+
+def _compress(data, compression):
+    if compression == 'zlib':
+        return zlib.compress(data)
+    elif compression == 'lz4':
+        import lz4.block
+        return lz4.block.compress(data, store_size=False)
+
+def _decompress(data, code, size):
+    if code == COMPRESSIONS['zlib']:
+        return zlib.decompress(data)
+    elif code == COMPRESSIONS['lz4']:
+        import lz4.block
+        return lz4.block.decompress(data, uncompressed_size=size)
+    raise Exception('Unknown raster compression code {}'.format(code))
+
+def _compressed_pixels(band, width, height, endian):
+    # the pixels of a band with a compression, encoded as:
+    #
+    # +-------------+-------------+-----------------------------------+
+    # | (nothing)   |             | if isNodataValue, all pixels are  |
+    # |             |             | the nodata value                  |
+    # +-------------+-------------+-----------------------------------+
+    # | code        | uint8       | 0: constant, followed by a single |
+    # |             |             | pixel value                       |
+    # |             |             | 1: zlib, 2: lz4, +128 if the      |
+    # |             |             | bytes were shuffled, followed by: |
+    # +-------------+-------------+-----------------------------------+
+    # | length      | uint32      | compressed length                 |
+    # +-------------+-------------+-----------------------------------+
+    # | data        | bytes       | compressed pixels                 |
+    # +-------------+-------------+-----------------------------------+
+    #
+    # Shuffling groups the first byte of every pixel, then the second, and so on,
+    # which gives much longer runs for the compressor when neighbouring values are similar.
+    if band['compression'] not in COMPRESSIONS:
+        raise Exception('Unknown raster compression "{}", must be one of {}'.format(band['compression'], sorted(COMPRESSIONS)))
+    if band['isNodataValue']:
+        return b''
+    pixtype = band['pixtype']
+    arr = np.ascontiguousarray(band['ndarray'], dtype=np.dtype(endian + dtypes[pixtype]))
+    first = arr.flat[0]
+    if (arr == first).all():
+        return pack(endian + 'B' + fmts[pixtype], CONSTANT, first)
+    code = COMPRESSIONS[band['compression']]
+    if arr.itemsize > 1:
+        data = arr.view(np.uint8).reshape((-1, arr.itemsize)).T.tobytes()
+        code |= SHUFFLED
+    else:
+        data = arr.tobytes()
+    data = _compress(data, band['compression'])
+    return pack(endian + 'BI', code, len(data)) + data
+
+def _read_compressed_pixels(wkb, offset, endian, pixtype, width, height, band):
+    # returns the pixel array and the offset after the band, see _compressed_pixels()
+    dtype = np.dtype(endian + dtypes[pixtype])
+    if band['isNodataValue']:
+        return np.full((height, width), band['nodata'], dtype=dtype), offset
+    (code,) = unpack_from(endian + 'B', wkb, offset)
+    offset += 1
+    if code == CONSTANT:
+        (value,) = unpack_from(endian + fmts[pixtype], wkb, offset)
+        offset += sizes[pixtype]
+        return np.full((height, width), value, dtype=dtype), offset
+    (length,) = unpack_from(endian + 'I', wkb, offset)
+    offset += 4
+    names = dict((c,name) for name,c in COMPRESSIONS.items())
+    band['compression'] = names.get(code & ~SHUFFLED)
+    data = _decompress(bytes(wkb[offset:offset+length]), code & ~SHUFFLED, width * height * dtype.itemsize)
+    offset += length
+    if code & SHUFFLED:
+        shuffled = np.frombuffer(data, dtype=np.uint8).reshape((dtype.itemsize, -1))
+        data = shuffled.T.tobytes()
+    arr = np.frombuffer(data, dtype=dtype).reshape((height, width))
+    return arr, offset
+
+def _band_size(band, width, height, payload=None):
+    # number of bytes needed to write a band, payload is the compressed pixels if any
+    size = 1 + sizes[band['pixtype']]
+    if band['isOffline']:
+        size += 1 + len(band['path'].encode()) + 1
+    elif payload is not None:
+        size += len(payload)
+    else:
+        size += width * height * sizes[band['pixtype']]
+    return size
 
 def write_wkb_raster(bands, width, height, affine, srid=4326):
     """Write Numpy arrays to WKB raster.
+
+    The output is preallocated to its exact size and written in a single pass,
+    using the native byte order, so the pixels of each band are copied only once
+    and only byteswapped if the array itself is not in native order.
+    Bands with a 'compression' of 'zlib' or 'lz4' are compressed instead,
+    see _compressed_pixels().
+    Returns a bytearray.
     """
 
-    wkb = b''
+    endian = '<' if sys.byteorder == 'little' else '>'
+    payloads = [_compressed_pixels(band, width, height, endian)
+                if band.get('compression') and not band['isOffline'] else None
+                for band in bands]
+    size = 1 + 60 + sum(_band_size(band, width, height, payload) for band,payload in zip(bands, payloads))
+    wkb = bytearray(size)
+    offset = 0
 
     # Set the endiannes of the raster
     #
@@ -231,12 +362,12 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
     # | endiannes     | byte        | 1:ndr/little endian          |
     # |               |             | 0:xdr/big endian             |
     # +---------------+-------------+------------------------------+
-    endian = '>'
     if endian == '>':
         endiannes = 0
     elif endian == '<':
         endiannes = 1
-    wkb += pack('<b', endiannes)
+    pack_into('<b', wkb, offset, endiannes)
+    offset += 1
 
     # Write the raster header data.
     #
@@ -272,9 +403,10 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
     # +---------------+-------------+------------------------------+
     version = 0
     scaleX, skewX, ipX, skewY, scaleY, ipY = affine
-    wkb += pack(endian + 'HHddddddIHH', version, len(bands), scaleX, scaleY, ipX, ipY, skewX, skewY, srid, width, height)
+    pack_into(endian + 'HHddddddIHH', wkb, offset, version, len(bands), scaleX, scaleY, ipX, ipY, skewX, skewY, srid, width, height)
+    offset += 60
 
-    for band in bands:
+    for band,payload in zip(bands, payloads):
 
         # Write band header data
         #
@@ -296,7 +428,9 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
         # |               |              | must be called for the band with  |
         # |               |              | 'TRUE' as last argument.          |
         # +---------------+--------------+-----------------------------------+
-        # | reserved      | 1bit         | unused in this version            |
+        # | isCompressed  | 1bit         | reserved in the postgis format,   |
+        # |               |              | here used to mark that the pixels |
+        # |               |              | are compressed                    |
         # +---------------+--------------+-----------------------------------+
         # | pixtype       | 4bits        | 0: 1-bit boolean                  |
         # |               |              | 1: 2-bit unsigned integer         |
@@ -322,17 +456,12 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
             bits = (bits & int('10111111', 2)) | int('01000000', 2) # second bit
         if band['isNodataValue']:
             bits = (bits & int('11011111', 2)) | int('00100000', 2) # third bit
+        if payload is not None:
+            bits = (bits & int('11101111', 2)) | int('00010000', 2) # fourth bit
 
         # Based on the pixel type, determine the struct format, byte size and
         # numpy dtype
         pixtype = band['pixtype']
-        
-        fmts = ['?', 'B', 'B', 'b', 'B', 'h',
-                'H', 'i', 'I', 'f', 'd']
-        dtypes = ['b1', 'u1', 'u1', 'i1', 'u1', 'i2',
-                  'u2', 'i4', 'u4', 'f4', 'f8']
-        #dtypes = ['bool', 'uint8', 'uint8', 'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float32', 'float64']
-        sizes = [1, 1, 1, 1, 1, 2, 2, 4, 4, 4, 8]
 
         dtype = dtypes[pixtype]
         size = sizes[pixtype]
@@ -340,11 +469,13 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
         bits = (bits & int('11110000', 2)) | (pixtype & int('00001111', 2))
 
         # Write the bits to a byte
-        wkb += pack(endian + 'b', bits)
+        pack_into(endian + 'B', wkb, offset, bits)
+        offset += 1
 
         # Write the nodata value
         nodata = band['nodata']
-        wkb += pack(endian + fmt, nodata)
+        pack_into(endian + fmt, wkb, offset, nodata)
+        offset += size
 
         if band['isOffline']:
 
@@ -360,11 +491,17 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
 
             # offline bands are 1-based for user consumption, should be 0-based
             band_num = band['bandNumber'] - 1
-            wkb += pack(endian + 'B', band_num)
+            pack_into(endian + 'B', wkb, offset, band_num)
+            offset += 1
             
             path = band['path'].encode()
             path += b'\x00' # null terminated
-            wkb += pack(endian + '{}s'.format(len(path)), path)
+            pack_into(endian + '{}s'.format(len(path)), wkb, offset, path)
+            offset += len(path)
+
+        elif payload is not None:
+            wkb[offset:offset+len(payload)] = payload
+            offset += len(payload)
 
         else:
 
@@ -382,11 +519,12 @@ def write_wkb_raster(bands, width, height, affine, srid=4326):
             # |            |              |                                   |
             # +------------+--------------+-----------------------------------+
             
-            arr = band['ndarray']
-            if endian != arr.dtype.byteorder:
-                arr = arr.byteswap()
-            databytes = arr.tostring()
-            wkb += databytes
+            # assign into a view of the output, which also handles any
+            # byteswapping and non-contiguous arrays without intermediate copies
+            out = np.frombuffer(wkb, dtype=np.dtype(endian + dtype),
+                                count=width * height, offset=offset)
+            out.reshape((height, width))[...] = band['ndarray']
+            offset += width * height * size
 
     return wkb
 
@@ -0,0 +1,123 @@
+
+from collections import OrderedDict
+
+import numpy as np
+from affine import Affine
+
+# Zonal statistics of raster tiles within polygons.
+# Polygons are rasterized onto each tile they overlap, and the statistics of the
+# masked pixels are accumulated one tile at a time, so only a single tile needs
+# to be in memory no matter how large the zone is.
+
+def _rings(geom):
+    if geom.geom_type == 'Polygon':
+        return [geom.exterior] + list(geom.interiors)
+    elif geom.geom_type in ('MultiPolygon','GeometryCollection'):
+        return [ring for part in geom.geoms for ring in _rings(part)]
+    return []
+
+def rasterize(geom, affine, width, height):
+    '''Boolean mask of the pixels whose center is inside a polygon or multipolygon,
+    for a raster of the given affine transform and size.
+    Uses a vectorized scanline fill with the even-odd rule, so holes are left out.
+    '''
+    mask = np.zeros((height, width), dtype=bool)
+    inverse = ~Affine(*list(affine)[:6])
+    edges = []
+    for ring in _rings(geom):
+        coords = np.asarray(ring.coords)
+        if len(coords) < 3:
+            continue
+        xs,ys = inverse * (coords[:,0], coords[:,1])
+        edges.append(np.column_stack([xs[:-1], ys[:-1], xs[1:], ys[1:]]))
+    if not edges:
+        return mask
+    x0,y0,x1,y1 = np.concatenate(edges).T
+
+    # rows whose pixel center is crossed by each edge, half open so shared vertices count once
+    firstrow = np.maximum(np.ceil(np.minimum(y0, y1) - 0.5), 0).astype(np.int64)
+    lastrow = np.minimum(np.ceil(np.maximum(y0, y1) - 0.5) - 1, height - 1).astype(np.int64)
+    counts = np.maximum(lastrow - firstrow + 1, 0)
+    total = counts.sum()
+    if not total:
+        return mask
+    edge = np.repeat(np.arange(len(counts)), counts)
+    rows = firstrow[edge] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # x where each edge crosses the center of each row, sorted along each row
+    t = (rows + 0.5 - y0[edge]) / (y1[edge] - y0[edge])
+    xs = x0[edge] + t * (x1[edge] - x0[edge])
+    order = np.lexsort((xs, rows))
+    rows,xs = rows[order],xs[order]
+
+    # fill between each pair of crossings, as +1/-1 steps that are summed along the rows
+    starts = np.clip(np.ceil(xs[0::2] - 0.5), 0, width).astype(np.int64)
+    ends = np.clip(np.ceil(xs[1::2] - 0.5), 0, width).astype(np.int64)
+    steps = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(steps, (rows[0::2], starts), 1)
+    np.add.at(steps, (rows[0::2], ends), -1)
+    mask[:] = np.cumsum(steps, axis=1)[:, :width] > 0
+    return mask
+
+class ZonalStats(object):
+    '''Accumulates the count, sum, mean, min, max and histogram of the pixels
+    of a band inside a zone, one tile at a time. Nodata pixels are ignored.
+    With bins=None the histogram counts each unique value, which suits categorical
+    rasters, otherwise bins is a list of bin edges as in numpy.histogram.
+    '''
+    def __init__(self, band=0, bins=None):
+        self.band = band
+        self.bins = bins
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        if bins is None:
+            self.histogram = {}
+        else:
+            self.histogram = np.zeros(len(bins) - 1, dtype=np.int64)
+
+    def add(self, geom, rast):
+        # geom is a shapely polygon, and rast a raster tile in the same coordinates
+        xmin,ymin,xmax,ymax = geom.bounds
+        txmin,tymin,txmax,tymax = _tile_bounds(rast)
+        if xmax < txmin or xmin > txmax or ymax < tymin or ymin > tymax:
+            return
+        band = rast.bands[self.band]
+        mask = rasterize(geom, rast.affine, rast.width, rast.height)
+        data = band.data()
+        if band.nodataval is not None:
+            mask &= data != band.nodataval
+        self.add_values(data[mask])
+
+    def add_values(self, values):
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += values.sum(dtype=np.float64 if values.dtype.kind == 'f' else np.int64).item()
+        vmin,vmax = values.min().item(),values.max().item()
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+        if self.bins is None:
+            uniques,counts = np.unique(values, return_counts=True)
+            for value,count in zip(uniques.tolist(), counts.tolist()):
+                self.histogram[value] = self.histogram.get(value, 0) + count
+        else:
+            self.histogram += np.histogram(values, self.bins)[0]
+
+    def result(self):
+        stats = OrderedDict()
+        stats['count'] = self.count
+        stats['sum'] = self.sum
+        stats['mean'] = self.sum / float(self.count) if self.count else None
+        stats['min'] = self.min
+        stats['max'] = self.max
+        if self.bins is None:
+            stats['histogram'] = OrderedDict(sorted(self.histogram.items()))
+        else:
+            stats['histogram'] = self.histogram.tolist()
+        return stats
+
+def _tile_bounds(rast):
+    xs,ys = zip(*[rast.affine * (px,py) for px,py in [(0,0),(rast.width,0),(0,rast.height),(rast.width,rast.height)]])
+    return min(xs), min(ys), max(xs), max(ys)
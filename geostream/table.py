@@ -1,14 +1,49 @@
 
 import os
 import warnings
-from tempfile import TemporaryFile, mktemp
+import itertools
+import multiprocessing
+from array import array
+from tempfile import mktemp
 
 import sqlite3
 from sqlite3 import Binary
 
 from .verbose import track_progress
+from .indexes import RTreeIndex, PyramidIndex, TileGridIndex
 from . import vector
 from . import raster
+from . import ops
+from . import batchops
+
+# parallel compute workers, each with their own read-only workspace
+
+_worker_workspace = None
+
+def _compute_worker_init(path):
+    global _worker_workspace
+    from .workspace import Workspace
+    _worker_workspace = Workspace(path, 'r')
+
+def _compute_worker(task):
+    # compute the values for an oid range, returned as (value,oid) pairs ready for updating
+    table, value, where, start, end = task
+    query = 'SELECT {}, oid FROM {} WHERE oid BETWEEN ? AND ?'.format(value, table)
+    if where: query += ' AND ({})'.format(where)
+    cur = _worker_workspace._cursor()
+    # blobs can't be pickled, so send as bytes (text is always returned as unicode)
+    result = [(bytes(val) if isinstance(val, buffer) else val, oid)
+              for val,oid in cur.execute(query, (start, end))]
+    cur.close()
+    ops.clear_cache()
+    return result
+
+def _zonal_worker(task):
+    # zonal stats of the zones in an oid range, returned as (oid,stats) pairs
+    table, geofield, rasttable, rastfield, band, bins, where, start, end = task
+    table = Table(_worker_workspace, table)
+    rasttable = Table(_worker_workspace, rasttable)
+    return list(table._zonal_stats(rasttable, geofield, rastfield, band, bins, where, (start, end)))
 
 class Row(sqlite3.Row):
     def __str__(self):
@@ -60,13 +95,7 @@ class Table(object):
         return self.get('COUNT(oid)')
 
     def __iter__(self):
-        query = 'SELECT * FROM {}'.format(self.name)
-        cur = self._cursor()
-        result = cur.execute(query)
-        if len(self.fields) == 1:
-            return (row[0] for row in result)
-        else:
-            return result
+        return self.rows()
 
     def __getitem__(self, i):
         limit = 1
@@ -83,6 +112,30 @@ class Table(object):
     def _cursor(self):
         return self.workspace._cursor()
 
+    def _fieldstring(self, fields=None, decode=True, prefix=None):
+        # fields to select, where geom and rast fields are cast to plain blobs unless decode is true,
+        # since converters are only run for columns with a declared type
+        allfields = not fields or fields == ['*']
+        if prefix and not allfields:
+            # the rowid is ambiguous when joined with another table, eg the rtree
+            fields = ['{}.{} AS {}'.format(prefix, field, field) if field.lower() in ('oid','rowid','_rowid_') else field
+                      for field in fields]
+        if decode:
+            if allfields:
+                return '{}.*'.format(prefix) if prefix else '*'
+            return ', '.join(fields)
+        types = dict((name, typ.lower()) for name,typ in self.fields)
+        if allfields:
+            fields = [name if prefix is None else '{}.{}'.format(prefix, name) for name,_ in self.fields]
+        return ', '.join(('CAST({0} AS BLOB) AS {1}'.format(field, field.split('.')[-1])
+                          if types.get(field.split('.')[-1]) in ('geom','rast') else field
+                          for field in fields))
+
+    def decode(self, field, value):
+        # convert a raw value read with decode=False to the type of field
+        typ = dict(self.fields)[field]
+        return self.workspace.decode(value, typ)
+
     def _column_info(self):
         # cid,name,typ,notnull,default,pk
         if '.' in self.name:
@@ -118,6 +171,9 @@ class Table(object):
         typ = dtype
         cur = self._cursor()
         cur.execute('ALTER TABLE {name} ADD {field} {typ}'.format(name=self.name, field=field, typ=typ))
+        # the row encoders depend on the fields
+        self.workspace._geometry_encoders = dict((key,encoder) for key,encoder in self.workspace._geometry_encoders.items()
+                                                 if key[0] != self.name)
 
 ##        # enforce that failed type conversions become NULL
 ##        trigname = '{}_enforce_failed_type_insert'.format(self.name.replace('.','_'))
@@ -168,7 +224,7 @@ class Table(object):
                      ident+u'Data Type: {}'.format(typ)]
             
             if typ == 'geom':
-                spindex = self.workspace.table('spatial_indexes').get('COUNT(oid)', where="tbl = '{}' and fld = '{}'".format(self.name, field))
+                spindex = self.workspace.table('spatial_indexes').get('COUNT(oid)', where="tbl = '{}' and col = '{}'".format(self.name, field))
                 lines += [ident+'Spatial Index: {}'.format(bool(spindex))]
                 # some more too
                 # ...
@@ -212,14 +268,30 @@ class Table(object):
 
     #### Reading
 
-    def get(self, fields=None, where=None):
+    def rows(self, fields=None, where=None, decode=True):
+        '''Iterate the rows of the table, same as iterating the table itself.
+        With decode=False, geom and rast fields are returned as raw blobs instead of being
+        decoded, which is much faster for scans that don't need them, see also decode().
+        '''
+        if isinstance(fields, basestring):
+            fields = [fields]
+        fieldstring = self._fieldstring(fields, decode)
+        query = 'SELECT {} FROM {}'.format(fieldstring, self.name)
+        if where: query += u' WHERE {}'.format(where)
+        cur = self._cursor()
+        result = cur.execute(query)
+        if len(cur.description) == 1:
+            return (row[0] for row in result)
+        else:
+            return result
+
+    def get(self, fields=None, where=None, decode=True):
         if fields:
             if isinstance(fields, basestring):
                 fields = [fields]
-            fieldstring = ','.join(fields)
         else:
             fields = ['*']
-            fieldstring = '*'
+        fieldstring = self._fieldstring(fields, decode)
             
         query = 'SELECT {} FROM {}'.format(fieldstring, self.name)
         if where: query += u' WHERE {}'.format(where)
@@ -236,7 +308,7 @@ class Table(object):
             else:
                 return row
 
-    def values(self, fields, where=None, order=None, limit=None):
+    def values(self, fields, where=None, order=None, limit=None, decode=True):
         '''Iterate all of the unique values.
         RENAME unique() ?
         '''
@@ -247,7 +319,7 @@ class Table(object):
             order = [order]
 
         # fields query
-        fieldstring = ', '.join(fields)
+        fieldstring = self._fieldstring(fields, decode)
         query = 'SELECT DISTINCT {} FROM {}'.format(fieldstring, self.name)
         
         # where query
@@ -306,14 +378,86 @@ class Table(object):
 
     def add_row(self, *row, **kw):
         if row:
+            encoder = self._geometry_encoder()
+            if encoder:
+                row = encoder(row)
             questionmarks = ','.join(('?' for _ in row))
             self.workspace.c.execute('INSERT INTO {} VALUES ({})'.format(self.name, questionmarks), row)
         elif kw:
             cols,vals = list(zip(*kw.items()))
+            encoder = self._geometry_encoder(cols)
+            if encoder:
+                vals = encoder(vals)
             colstring = ','.join((col for col in cols))
             questionmarks = ','.join(('?' for _ in cols))
             self.workspace.c.execute('INSERT INTO {} ({}) VALUES ({})'.format(self.name, colstring, questionmarks), vals)
 
+    def add_rows(self, rows, fields=None):
+        '''Insert a sequence of rows using one prepared statement and executemany.
+        All rows must have the same length, either matching all the table fields,
+        or the list of fields if given.
+        '''
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        questionmarks = ','.join(('?' for _ in first))
+        if fields:
+            colstring = ','.join(fields)
+            query = 'INSERT INTO {} ({}) VALUES ({})'.format(self.name, colstring, questionmarks)
+        else:
+            query = 'INSERT INTO {} VALUES ({})'.format(self.name, questionmarks)
+        rows = itertools.chain([first], rows)
+        encoder = self._geometry_encoder(fields)
+        if encoder:
+            rows = itertools.imap(encoder, rows)
+        self.workspace.c.executemany(query, rows)
+
+    def _geometry_encoder(self, fields=None):
+        # returns a function that encodes the geometries of a row with the codec of each field,
+        # or None if all the fields are stored as plain wkb
+        # cached by the workspace, so the fields don't have to be looked up for every row
+        codecs = self.workspace.geometry_codecs()
+        key = (self.name, tuple(fields) if fields else None)
+        if key not in self.workspace._geometry_encoders:
+            self.workspace._geometry_encoders[key] = self._make_geometry_encoder(codecs, fields)
+        return self.workspace._geometry_encoders[key]
+
+    def _make_geometry_encoder(self, codecs, fields):
+        if not any(tbl == self.name for tbl,_ in codecs):
+            return None
+        fields = fields or self.fieldnames
+        encoders = [(i,codecs[(self.name,field)]) for i,field in enumerate(fields)
+                    if (self.name,field) in codecs]
+        if not encoders:
+            return None
+        def encoder(row):
+            row = list(row)
+            for i,(codec,precision,compression) in encoders:
+                if row[i] is not None:
+                    row[i] = vector.serialize.encode(row[i], codec, precision, compression)
+            return row
+        return encoder
+
+    def set_geometry_codec(self, geofield, codec='compact', precision=6, compression=None):
+        '''Set how the geometries of a field are stored, and re-encode any existing geometries.
+        The codec is either 'wkb' (the default), or 'compact' which rounds coordinates to
+        precision decimals and stores them as varint deltas, optionally compressed with
+        'zlib' or 'lz4'. See vector/serialize.py. Geometries are decoded the same way
+        regardless of codec, and new geometries are encoded when added or computed.
+        '''
+        if codec not in ('wkb','compact'):
+            raise Exception('Unknown geometry codec "{}", must be wkb or compact'.format(codec))
+        if compression not in vector.serialize.COMPRESSIONS:
+            raise Exception('Unknown geometry compression "{}", must be zlib or lz4'.format(compression))
+        self._fetchall('DELETE FROM geometry_codecs WHERE tbl = ? AND col = ?', (self.name, geofield))
+        if codec != 'wkb':
+            self._fetchall('INSERT INTO geometry_codecs VALUES (?,?,?,?,?)', (self.name, geofield, codec, precision, compression))
+        self.workspace._geometry_codecs = None
+        query = 'UPDATE {table} SET {field} = st_encode({field}, ?, ?, ?)'.format(table=self.name, field=geofield)
+        self._fetchall(query, (codec, precision, compression))
+        ops.clear_cache()
+
     def recode(self, field, *args, **kwargs):
         # Setting to multiple constant values depending on conditions
         if args:
@@ -332,18 +476,46 @@ class Table(object):
         
         self._fetchall(query, vals)
 
-    def compute(self, field, value, where=None, dtype=None, verbose=False):
+    def compute(self, field, value, where=None, dtype=None, verbose=False, workers=None, chunksize=10000, engine='sql'):
         '''Computing values for new or existing field
+        With engine='batch', the st_* functions in the value expression are run on chunks
+        of chunksize rows at a time, see batchops.py, and the rest of the expression by sqlite.
+        If workers is set, the table is split into oid ranges of about chunksize rows, and
+        the value expression is evaluated in a pool of that many processes, each reading
+        from its own read-only connection. Results are written back here in one transaction
+        per oid range. Best for cpu-heavy expressions, eg geometry functions.
         '''
+        if engine not in ('sql', 'batch'):
+            raise Exception('engine must be either "sql" or "batch", not "{}"'.format(engine))
         cursor = self._cursor()
         if value is None: value = 'NULL'
+
+        # encode geometries with the codec of the field, if any
+        codec = self.workspace.geometry_codecs().get((self.name, field))
+        if codec:
+            codec,precision,compression = codec
+            compression = "'{}'".format(compression) if compression else 'NULL'
+            value = "st_encode(({}), '{}', {}, {})".format(value, codec, precision, compression)
         valstring = '{} = {}'.format(field,value)
 
         # create new field if type is specified
         if dtype:
             self.add_field(field, dtype)
+
+        if engine == 'batch' and batchops.parse([value])[1]:
+            cursor.close()
+            temp,(value,) = self._batch_values([value], where, chunksize, verbose)
+            table = self.name.split('.')[-1]
+            query = 'UPDATE {} SET {} = (SELECT {} FROM {} WHERE _oid = {}.oid)'.format(self.name, field, value, temp, table)
+            if where: query += ' WHERE {}'.format(where)
+            self._fetchall(query)
+            self._fetchall('DROP TABLE {}'.format(temp))
+
+        elif workers:
+            cursor.close()
+            self._compute_parallel(field, value, where, workers, chunksize, verbose)
         
-        if verbose:
+        elif verbose:
             # prepare loop incl progress tracking
             loop = self.values('oid', where=where)
             if where:
@@ -367,6 +539,75 @@ class Table(object):
             cursor.execute(query)
             cursor.close()
 
+        # statement is finished, so parsed geometries are no longer needed
+        ops.clear_cache()
+
+    def _compute_parallel(self, field, value, where, workers, chunksize, verbose):
+        if self.name.lower().startswith(('temp','temporary')):
+            raise Exception('Parallel compute is not possible for temporary tables, since these are not visible to other processes')
+
+        # split into oid ranges
+        (minoid,maxoid), = self._fetchall('SELECT MIN(oid), MAX(oid) FROM {}'.format(self.name))
+        if minoid is None:
+            return
+        ranges = [(start, min(start+chunksize-1, maxoid))
+                  for start in range(minoid, maxoid+1, chunksize)]
+        tasks = [(self.name, value, where, start, end) for start,end in ranges]
+
+        # readers and the writer may not block each other, which requires the wal journal mode
+        (journal,), = self._fetchall('PRAGMA journal_mode')
+        if journal.lower() != 'wal':
+            self._fetchall('PRAGMA journal_mode = WAL')
+
+        pool = multiprocessing.Pool(workers, initializer=_compute_worker_init, initargs=(self.workspace.path,))
+        try:
+            results = pool.imap_unordered(_compute_worker, tasks)
+            if verbose:
+                results = track_progress(results, 'Computing values with {} workers'.format(workers), total=len(tasks))
+            query = 'UPDATE {} SET {} = ? WHERE oid = ?'.format(self.name, field)
+            cursor = self._cursor()
+            for result in results:
+                cursor.execute('BEGIN')
+                cursor.executemany(query, ((Binary(val) if isinstance(val, bytes) else val, oid)
+                                           for val,oid in result))
+                cursor.execute('COMMIT')
+            cursor.close()
+        finally:
+            pool.close()
+            pool.join()
+            if journal.lower() != 'wal':
+                self._fetchall('PRAGMA journal_mode = {}'.format(journal))
+
+    def _batch_values(self, exprs, where, chunksize, verbose):
+        # evaluates the batch calls of the expressions into a temporary table of _oid and value columns
+        # returns the temporary table name and the expressions rewritten to refer to its columns
+        exprs,steps,fields,outputs = batchops.parse(exprs)
+        tempname = os.path.split(mktemp())[1]
+        columns = ''.join(', {}'.format(name) for name in outputs)
+        self._fetchall('CREATE TEMP TABLE {} (_oid INTEGER PRIMARY KEY{})'.format(tempname, columns))
+
+        # geometries are read as raw blobs, so they are only parsed if needed
+        fieldstring = ', '.join(('CAST({} AS BLOB)'.format(field) if geom else field
+                                 for field,geom in fields.items()))
+        query = 'SELECT oid, {} FROM {}'.format(fieldstring, self.name)
+        if where: query += ' WHERE {}'.format(where)
+        insert = 'INSERT INTO {} VALUES ({})'.format(tempname, ', '.join('?' * (len(outputs)+1)))
+        cursor = self._cursor()
+        cursor.execute(query)
+        chunks = iter(lambda: cursor.fetchmany(chunksize), [])
+        if verbose:
+            chunks = track_progress(chunks, 'Computing values in batches of {}'.format(chunksize))
+        writer = self._cursor()
+        for rows in chunks:
+            oids = [row[0] for row in rows]
+            columns = dict((field, [row[i+1] for row in rows]) for i,field in enumerate(fields))
+            results = batchops.evaluate(steps, columns, outputs)
+            writer.executemany(insert, itertools.izip(oids, *results))
+        cursor.close()
+        writer.close()
+
+        return 'temp.{}'.format(tempname), exprs
+
     #### Manipulations
 
     def select(self, fields=None, where=None, limit=None, output=False, replace=False):
@@ -426,6 +667,54 @@ class Table(object):
         # return the new table to user
         return Table(self.workspace, output, 'w')
 
+    def spatial_join(self, other, predicate='intersects', geofield='geom', othergeofield='geom', keep_fields=None, output=False, replace=False):
+        '''Join each row with the rows of another table whose geometries match the given predicate.
+        Predicate can be one of intersects, contains, within, covers, touches, crosses, or overlaps.
+        The other table must have a spatial index for its geometry field, which is probed
+        with the bbox of each row in this table, so only the candidate pairs are tested.
+        In the resulting query, this table is available as "left" and the other table as "right".
+        '''
+        predicates = ('intersects','contains','within','covers','touches','crosses','overlaps')
+        if predicate not in predicates:
+            raise Exception('Spatial join predicate must be one of: {}'.format(', '.join(predicates)))
+        
+        # wrap single args in lists
+        if isinstance(keep_fields, basestring):
+            keep_fields = [keep_fields]
+
+        # by default keep all fields
+        if not keep_fields:
+            keep_fieldstring = 'left.*, right.*'
+        else:
+            keep_fieldstring = ', '.join(keep_fields)
+
+        # the spatial index of the other table
+        spindex = other.load_spatial_index(othergeofield)
+
+        # construct query
+        # NOTE: cross join forces sqlite to loop this table first, and then probe the rtree
+        # for each row, so the same left geometry gets tested against all its candidates in a row
+        query = '''SELECT {fields} FROM {left} AS left
+                    CROSS JOIN {rtree} AS _idx
+                        ON _idx._xmax >= st_xmin(left.{geofield}) AND _idx._xmin <= st_xmax(left.{geofield})
+                        AND _idx._ymax >= st_ymin(left.{geofield}) AND _idx._ymin <= st_ymax(left.{geofield})
+                    CROSS JOIN {right} AS right
+                        ON right.oid = _idx._oid
+                    WHERE st_{predicate}(left.{geofield}, right.{othergeofield})
+                    '''.format(fields=keep_fieldstring,
+                               left=self.name,
+                               rtree=spindex.name,
+                               right=other.name,
+                               geofield=geofield,
+                               othergeofield=othergeofield,
+                               predicate=predicate)
+
+        # execute and store in normal or temporary table
+        output = self._query_to_table(query, output=output, replace=replace)
+
+        # return the new table to user
+        return Table(self.workspace, output, 'w')
+
     def reshape(self, columns, fields):
         # https://stackoverflow.com/questions/2444708/sqlite-long-to-wide-formats
         # ...
@@ -433,16 +722,28 @@ class Table(object):
         
     #### Stats
 
-    def aggregate(self, stats, by=None, where=None, order=None, output=False, replace=False):
+    def aggregate(self, stats, by=None, where=None, order=None, output=False, replace=False, chunksize=10000, engine='sql'):
         '''Create a table of aggregates statistics.
+        With engine='batch', the st_* functions inside the stats are first run on chunks
+        of chunksize rows at a time, see batchops.py, and then aggregated by sqlite.
         '''
         # wrap single args in lists
+        if engine not in ('sql', 'batch'):
+            raise Exception('engine must be either "sql" or "batch", not "{}"'.format(engine))
         if isinstance(stats, basestring):
             stats = [stats]
         if by and isinstance(by, basestring):
             by = [by]
         if order and isinstance(order, basestring):
             order = [order]
+
+        # batch values
+        if engine == 'batch' and batchops.parse(stats)[1]:
+            temp,stats = self._batch_values(stats, where, chunksize, False)
+            table = self.name.split('.')[-1]
+            fromstring = '{} LEFT JOIN {} ON _oid = {}.oid'.format(self.name, temp, table)
+        else:
+            fromstring = self.name
             
         # auto add groupby to stats
         if by:
@@ -450,7 +751,7 @@ class Table(object):
             
         # stats query
         statstring = ', '.join(stats)
-        query = 'SELECT {} FROM {}'.format(statstring, self.name)
+        query = 'SELECT {} FROM {}'.format(statstring, fromstring)
         
         # where query
         if where:
@@ -468,6 +769,8 @@ class Table(object):
 
         # execute and store in normal or temporary table
         output = self._query_to_table(query, output=output, replace=replace)
+        if fromstring != self.name:
+            self._fetchall('DROP TABLE {}'.format(temp))
 
         # return the new table to user
         return Table(self.workspace, output, 'w')
@@ -518,123 +821,223 @@ class Table(object):
             
     #### Spatial indexing
 
-    # TODO: Move all spatial indexing to separate class
-    # incl moving the spatial_indexes memory dict to the new class
-    # ...
-
-    # TODO: Maybe custom implement rtrees as tables
-    # using pure python pyrtree to easily populate
-    # the node, parent, and rowid tables
-    # see: https://stackoverflow.com/questions/25241406/best-option-for-supplying-quadtree-gps-data-to-an-app/25242162#25242162
-    # https://github.com/pvanek/sqliteman/tree/master/Sqliteman/sqliteman/extensions/rtree
-    # https://github.com/endlesssoftware/sqlite3/blob/master/rtree.c
-
     # TODO: Consider implementing quadtree tables as well
     # perhaps based on pyqtree and update to be more efficient
     # http://lspiroengine.com/?p=530
+
+    # NOTE: Spatial indexes are SQLite R*Tree virtual tables stored in the workspace itself
+    # see: https://www.sqlite.org/rtree.html
             
-    def create_spatial_index(self, geofield, verbose=True):
+    def create_spatial_index(self, geofield, replace=False, bulk=True, verbose=True, callback=None):
+        '''Create an rtree spatial index for a geom or rast field.
+        With bulk=True, all (oid,bbox) pairs are read in one pass and the tree is packed
+        bottom up in Sort-Tile-Recursive order, which gives faster builds and full,
+        spatially compact nodes. With bulk=False, bboxes are inserted one at a time in oid order.
+        The index is kept up to date by triggers that call geostream's st_*/rt_* sql functions, so
+        once indexed, the table can only be written to from connections where these are registered,
+        ie through a Workspace. Other tools like the sqlite3 shell fail with "no such function"
+        when inserting, updating or deleting rows, unless the index is dropped first.
+        The progress and timings of reading the bboxes and building the tree are reported with
+        track_progress if verbose, or to callback if given, see verbose.py.
+        '''
         # create the spatial index
-        import rtree
-        temppath = TemporaryFile().name
-        spindex = rtree.index.Index(temppath)
-        spindex._temppath = temppath
-        self.workspace.spatial_indexes[(self.name, geofield)] = spindex
+        if self.has_spatial_index(geofield):
+            if replace:
+                self.drop_spatial_index(geofield)
+            else:
+                raise Exception('Table "{}" already has a spatial index for field "{}"'.format(self.name, geofield))
+        spindex = RTreeIndex(self.workspace, self.name, geofield)
+        spindex.create()
+
+        # read the bboxes with sql, which only reads the bbox stored in each geom or rast header
+        typ = next((t for f,t in self.fields if f == geofield))
+        prefix = RTreeIndex.bboxfuncs[typ.lower()]
+        bboxstring = ', '.join(('{}_{}({})'.format(prefix, coord, geofield)
+                                for coord in ('xmin','ymin','xmax','ymax')))
+        cur = self._cursor()
+        bboxes = cur.execute('SELECT oid, {} FROM {} WHERE {} IS NOT NULL'.format(bboxstring, self.name, geofield))
+
+        if verbose or callback:
+            total = self.get('COUNT(oid)', where='{} IS NOT NULL'.format(geofield))
+            kwargs = dict(callback=callback) if callback else {}
+            bboxes = track_progress(bboxes, 'Reading bboxes for Spatial Index of Field "{}" on Table "{}"'.format(geofield, self.name), total=total, **kwargs)
+
+        def iterbboxes():
+            for oid,x1,y1,x2,y2 in bboxes:
+                # skip empty geometries
+                if x1 is None:
+                    continue
+                yield oid,x1,y1,x2,y2
+
+        if bulk:
+            # read all oids and bboxes in one pass into compact arrays
+            oids = array('l')
+            coords = array('d')
+            for oid,x1,y1,x2,y2 in iterbboxes():
+                oids.append(oid)
+                coords.extend((x1,y1,x2,y2))
+            import numpy as np
+            oids = np.frombuffer(oids, dtype=np.int_) if oids else np.zeros(0, dtype=np.int_)
+            bboxes = np.frombuffer(coords, dtype=np.float64).reshape((-1,4)) if coords else np.zeros((0,4))
+            self.begin()
+            spindex.bulk_load(oids, bboxes, verbose=verbose, callback=callback)
+            self.commit()
+        else:
+            items = ((oid,x1,x2,y1,y2) for oid,x1,y1,x2,y2 in iterbboxes())
+            self.begin()
+            spindex.insert_many(items)
+            self.commit()
 
-        # NOTE: Maybe consider using generator as input to Index()
-        # but this seems to only be in memory then, and not on file
-        geoms = self.select(['oid',geofield])
-##        i = 0
-##        for g in geoms:
-##            print g
-##            i+=1
-##        print i
-##        fdsf
+        # from now on the index is updated incrementally on each insert, update, or delete
+        spindex.create_triggers(typ)
 
-        if verbose:
-            geoms = track_progress(geoms, 'Creating Spatial Index for Field "{}" on Table "{}"'.format(geofield, self.name), total=len(self))
-            
-        for oid,geom in geoms:
-            if geom:
-                bbox = geom.bounds if hasattr(geom, 'bounds') else geom.bbox
-                # ensure min,min,max,max pattern
-                xs = bbox[0],bbox[2]
-                ys = bbox[1],bbox[3]
-                bbox = [min(xs),min(ys),max(xs),max(ys)]
-                # insert
-                spindex.insert(oid, bbox)
-                
         # add new entry to the spatial index table
         idxtable = self.workspace.table('spatial_indexes')
-        idxtable.add_row(tbl=self.name, col=geofield)
+        idxtable.add_row(tbl=self.name, col=geofield, rtree=spindex.name)
+        self.workspace.spatial_indexes[(self.name, geofield)] = spindex
+
+    def has_spatial_index(self, geofield):
+        if (self.name,geofield) in self.workspace.spatial_indexes:
+            return True
+        idxtable = self.workspace.table('spatial_indexes')
+        if 'rtree' not in idxtable.fieldnames:
+            # read only workspace from before the indexes were stored as rtrees
+            return False
+        return bool(idxtable.get('COUNT(oid)', where="tbl = '{}' AND col = '{}'".format(self.name, geofield)))
 
     def load_spatial_index(self, geofield):
         if (self.name,geofield) in self.workspace.spatial_indexes:
             # already loaded in spatial_indexes dict
             spindex = self.workspace.spatial_indexes[(self.name,geofield)]
         else:
-            # load idx and dat blob data
-            idxtable = self.workspace.table('spatial_indexes')
-            print 'retrieving idx and dat binary strings from db'
-            cur = idxtable._cursor()
-            (idx,dat) = cur.execute('''select rtree_idx,rtree_dat FROM {rtree} WHERE tbl = '{table}' AND col = '{geofield}' '''.format(rtree=idxtable.name, table=self.name, geofield=geofield)).fetchone()
-            cur.close()
-            # write to temp file
-            temppath = TemporaryFile().name
-            with open(temppath+'.idx', 'wb') as fobj:
-                print 'placing .idx on disk'
-                fobj.write(idx)
-            with open(temppath+'.dat', 'wb') as fobj:
-                print 'placing .dat on disk'
-                fobj.write(dat)
-            import rtree
-            # load index from temp file
-            print 'creating rtree from files'
-            spindex = rtree.index.Index(temppath)
-            print 'created'
-            spindex._temppath = temppath
+            # the index already lives in the db, so only need to check that it exists
+            if not self.has_spatial_index(geofield):
+                raise Exception('You need to create the spatial index for field "{}" before you can use it'.format(geofield))
+            spindex = RTreeIndex(self.workspace, self.name, geofield)
             # update spatial_indexes dict
             self.workspace.spatial_indexes[(self.name,geofield)] = spindex
         return spindex
 
     def store_spatial_index(self, geofield):
-        spindex = self.workspace.spatial_indexes.pop((self.name,geofield))
-        spindex.close()
-        temppath = spindex._temppath
-        # get the byte data from the files
-        with open(temppath+'.idx', 'rb') as fobj:
-            idx = Binary(fobj.read())
-        with open(temppath+'.dat', 'rb') as fobj:
-            dat = Binary(fobj.read())
-        # delete the temporary files from disk
-        os.remove(temppath+'.idx')
-        os.remove(temppath+'.dat')
-        # update the idx and dat columns in the spatial_indexes table
+        # the rtree is always stored in the db, so only need to release it from memory
+        self.workspace.spatial_indexes.pop((self.name,geofield), None)
+
+    def drop_spatial_index(self, geofield):
+        spindex = self.load_spatial_index(geofield)
+        spindex.drop()
         idxtable = self.workspace.table('spatial_indexes')
-        cur = idxtable._cursor()
-        cur.execute('''UPDATE {rtree} SET rtree_idx=:idx, rtree_dat=:dat,
-                     WHERE tbl = '{table}' AND col = '{geofield}' '''.format(rtree=idxtable.name, table=self.name, geofield=geofield),
-                    dict(idx=idx, dat=dat))
-        cur.close()
-
-    def intersection(self, geofield, bbox, fields=None):
-        #if not hasattr(self, "spindex"):
-        #    raise Exception("You need to create the spatial index before you can use this method")
+        idxtable._fetchall("DELETE FROM {} WHERE tbl = '{}' AND col = '{}'".format(idxtable.name, self.name, geofield))
+        self.store_spatial_index(geofield)
+
+    def create_overviews(self, geofield='rast', levels=None, resampling='mean', verbose=True):
+        '''Build overview levels of a raster field, each at half the resolution of the one below it.
+        levels is the number of levels, or None to continue until a level fits in a single tile.
+        resampling is either 'mean', 'mode' or 'nearest', or a list with one for each band.
+        Any existing levels are replaced.
+        '''
+        pyramid = PyramidIndex(self.workspace, self.name, geofield)
+        pyramid.build(levels, resampling, verbose=verbose)
+        return pyramid
+
+    def tile_grid(self, geofield='rast'):
+        return TileGridIndex(self.workspace, self.name, geofield)
+
+    def overviews(self, geofield='rast'):
+        return PyramidIndex(self.workspace, self.name, geofield)
+
+    def drop_overviews(self, geofield='rast'):
+        PyramidIndex(self.workspace, self.name, geofield).drop()
+
+    def intersection(self, geofield, bbox, fields=None, decode=True, resolution=None):
+        # with resolution, raster tiles are read from the coarsest overview level that is
+        # at least as detailed as the requested cell size, if the field has overviews
+        if resolution is not None:
+            level = PyramidIndex(self.workspace, self.name, geofield).level(resolution)
+            if level != self.name:
+                return self.workspace.table(level).intersection(geofield, bbox, fields, decode)
         # ensure min,min,max,max pattern
         xs = bbox[0],bbox[2]
         ys = bbox[1],bbox[3]
         bbox = [min(xs),min(ys),max(xs),max(ys)]
+        xmin,ymin,xmax,ymax = bbox
+        # raster tables with a tile grid find the tiles arithmetically
+        grid = TileGridIndex(self.workspace, self.name, geofield)
+        if grid.exists():
+            ranges = grid.ranges(bbox)
+            if ranges is None:
+                return iter([])
+            fieldstring = self._fieldstring(fields, decode)
+            query = '''SELECT {fields} FROM {table}
+                        WHERE tile_row BETWEEN ? AND ? AND tile_col BETWEEN ? AND ?
+                        '''.format(fields=fieldstring, table=self.name)
+            cur = self._cursor()
+            return cur.execute(query, ranges)
         # load the spindex
         spindex = self.load_spatial_index(geofield)
-        # return generator over results
-        ids = spindex.intersection(bbox)
-        #ids = self.spindex.intersect(bbox)
-        idstring = ','.join(map(str,ids))
-        fieldstring = ','.join(fields) if fields else '*'
+        # return generator over results, by joining with the rtree
+        fieldstring = self._fieldstring(fields, decode, prefix=self.name.split('.')[-1])
+        query = '''SELECT {fields} FROM {rtree} AS _idx
+                    JOIN {table} ON {table}.oid = _idx._oid
+                    WHERE _idx._xmax >= ? AND _idx._xmin <= ? AND _idx._ymax >= ? AND _idx._ymin <= ?
+                    '''.format(fields=fieldstring, rtree=spindex.name, table=self.name)
         cur = self._cursor()
-        return cur.execute('''SELECT {fields} FROM {table} WHERE oid IN ({oids})'''.format(fields=fieldstring,
-                                                                                           table=self.name,
-                                                                                           oids=idstring))
+        return cur.execute(query, (xmin, xmax, ymin, ymax))
+
+    def zonal_stats(self, raster, geofield='geom', rastfield='rast', band=0, bins=None, where=None,
+                    workers=None, chunksize=100, verbose=False):
+        '''Zonal statistics of a raster table within each polygon of this table.
+        Yields an (oid, stats) pair for each row, where stats is a dict of the count, sum, mean,
+        min, max and histogram of the pixels of the band whose centers are inside the polygon.
+        With bins=None the histogram counts each unique value, otherwise bins is a list of bin edges.
+        Tiles are streamed one at a time from raster.intersection(), so the raster table needs
+        a tile grid (as made by import_raster) or a spatial index.
+        With workers, the zones are split into oid ranges of chunksize rows and processed in parallel.
+        The same statistics are available in sql as the rt_zonalstats(rast, geom [, band [, bins]]) aggregate.
+        '''
+        if isinstance(raster, basestring):
+            raster = self.workspace.table(raster)
+        if workers:
+            results = self._zonal_stats_parallel(raster, geofield, rastfield, band, bins, where, workers, chunksize)
+        else:
+            results = self._zonal_stats(raster, geofield, rastfield, band, bins, where)
+        if verbose:
+            total = self.get('COUNT(oid)', where=where)
+            results = track_progress(results, 'Computing zonal statistics', total=total)
+        return results
+
+    def _zonal_stats(self, rasttable, geofield, rastfield, band, bins, where, oidrange=None):
+        query = 'SELECT oid, CAST({} AS BLOB) FROM {}'.format(geofield, self.name)
+        conditions = []
+        if oidrange: conditions.append('oid BETWEEN {} AND {}'.format(*oidrange))
+        if where: conditions.append('({})'.format(where))
+        if conditions: query += ' WHERE ' + ' AND '.join(conditions)
+        for oid,wkb in self._cursor().execute(query):
+            stats = raster.zonal.ZonalStats(band, bins)
+            if wkb is not None:
+                geom = vector.serialize.from_wkb(wkb)
+                if not geom.is_empty:
+                    tiles = rasttable.intersection(rastfield, geom.bounds, fields=[rastfield], decode=False)
+                    for tile, in tiles:
+                        stats.add(geom, raster.serialize.from_wkb_buffer(tile))
+            yield oid, stats.result()
+
+    def _zonal_stats_parallel(self, rasttable, geofield, rastfield, band, bins, where, workers, chunksize):
+        if self.name.lower().startswith(('temp','temporary')):
+            raise Exception('Parallel zonal stats is not possible for temporary tables, since these are not visible to other processes')
+        (minoid,maxoid), = self._fetchall('SELECT MIN(oid), MAX(oid) FROM {}'.format(self.name))
+        if minoid is None:
+            return
+        tasks = [(self.name, geofield, rasttable.name, rastfield, band, bins, where, start, min(start+chunksize-1, maxoid))
+                 for start in range(minoid, maxoid+1, chunksize)]
+        pool = multiprocessing.Pool(workers, initializer=_compute_worker_init, initargs=(self.workspace.path,))
+        try:
+            # in order, so the zones are returned in the same order as without workers
+            for result in pool.imap(_zonal_worker, tasks):
+                for item in result:
+                    yield item
+        finally:
+            pool.close()
+            pool.join()
 
     #### Exporting
     
@@ -3,5 +3,6 @@ from . import load
 from . import dump
 from . import fileformats
 from . import serialize
+from . import geography
 
 
@@ -1,31 +1,441 @@
 
 import sqlite3
 from sqlite3 import Binary
+from struct import pack, unpack_from
+import zlib
+
+import numpy as np
 
 from shapely.wkb import loads as wkb_loads
 from shapely.geometry import shape
 from shapely.geometry import Point, MultiPoint, LineString, MultiLineString, Polygon, MultiPolygon
 
 
+# Geometries are stored as WKB prefixed with a GeoPackage binary header,
+# which caches the bbox envelope so it can be read without parsing the geometry.
+# See: http://www.geopackage.org/spec/#gpb_format
+#
+# +---------------+-------------+--------------------------------------+
+# | magic         | 2 bytes     | 'GP'                                 |
+# +---------------+-------------+--------------------------------------+
+# | version       | uint8       | 0                                    |
+# +---------------+-------------+--------------------------------------+
+# | flags         | uint8       | bit 0: header byte order (1=little)  |
+# |               |             | bits 1-3: envelope contents (0=none, |
+# |               |             | 1=xy)                                |
+# |               |             | bit 4: empty geometry                |
+# |               |             | bit 5: compact encoding (see below)  |
+# +---------------+-------------+--------------------------------------+
+# | srs_id        | int32       | 0 (undefined)                        |
+# +---------------+-------------+--------------------------------------+
+# | envelope      | 4 x float64 | minx,maxx,miny,maxy (if flagged)     |
+# +---------------+-------------+--------------------------------------+
+#
+# Points are stored without an envelope, since their coordinates
+# are at a fixed position right after the header, except in the compact encoding.
+
+HEADER_MAGIC = b'GP'
+ENVELOPE_SIZES = {0:0, 1:32, 2:48, 3:48, 4:64}
+
+def _header(shp):
+    if shp.is_empty:
+        flags = 1 | (1 << 4)
+        return pack('<2sBBi', HEADER_MAGIC, 0, flags, 0)
+    elif shp.geom_type == 'Point':
+        flags = 1
+        return pack('<2sBBi', HEADER_MAGIC, 0, flags, 0)
+    else:
+        flags = 1 | (1 << 1)
+        xmin,ymin,xmax,ymax = shp.bounds
+        return pack('<2sBBi4d', HEADER_MAGIC, 0, flags, 0, xmin, xmax, ymin, ymax)
+
+def _header_info(wkb_buf):
+    # returns the header flags and the size of the header, or None for plain wkb without a header
+    if wkb_buf[:2] != HEADER_MAGIC:
+        return None, 0
+    (flags,) = unpack_from('<B', wkb_buf, 3)
+    envelope = (flags >> 1) & 7
+    return flags, 8 + ENVELOPE_SIZES[envelope]
+
 def shapely_to_wkb(shp):
     # shapely to wkb buffer
-    wkb = shp.wkb
+    wkb = _header(shp) + shp.wkb
     buf = Binary(wkb)
     return buf
 
 def geoj_to_wkb(geoj):
     # geojson to wkb buffer
-    wkb = shape(geoj).wkb
+    shp = shape(geoj)
+    wkb = _header(shp) + shp.wkb
     buf = Binary(wkb)
     return buf
 
 def from_wkb(wkb_buf):
     # wkb buffer to shapely
-    shp = wkb_loads(bytes(wkb_buf))
+    flags,size = _header_info(wkb_buf)
+    if flags is not None and flags & COMPACT_FLAG:
+        return wkb_loads(_compact_to_wkb(wkb_buf, size))
+    shp = wkb_loads(bytes(wkb_buf[size:]))
     return shp
 
+# Compact encoding, an alternative to wkb selected per table, see Table.set_geometry_codec.
+# Like TWKB, coordinates are rounded to a number of decimals and stored as zigzag varint
+# deltas from the previous coordinate. Unlike TWKB, the geometry structure (types and counts)
+# is stored first, followed by all the coordinates, so these can be decoded in one go with numpy
+# and then written directly into plain wkb to be parsed by shapely.
+# See: https://github.com/TWKB/Specification/blob/master/twkb.md
+#
+# +---------------+-------------+--------------------------------------+
+# | header        | 40 bytes    | always with an xy envelope           |
+# +---------------+-------------+--------------------------------------+
+# | precision     | int8        | number of decimals kept              |
+# +---------------+-------------+--------------------------------------+
+# | compression   | uint8       | 0=none, 1=zlib, 2=lz4                |
+# +---------------+-------------+--------------------------------------+
+# | payload       | varints     | structure followed by coordinates,   |
+# |               |             | compressed as a whole if flagged     |
+# +---------------+-------------+--------------------------------------+
+#
+# The structure is the geometry type code (1-7 as in wkb), followed by the number of
+# points for linestrings, the number of rings and their number of points for polygons,
+# or the number of parts and the structure of each part for multi geometries.
+# Only 2D geometries are supported, others are stored as wkb.
+
+COMPACT_FLAG = 1 << 5
+COMPRESSIONS = {None:0, 'zlib':1, 'lz4':2}
+_GEOMTYPES = {'Point':1, 'LineString':2, 'LinearRing':2, 'Polygon':3, 'MultiPoint':4,
+              'MultiLineString':5, 'MultiPolygon':6, 'GeometryCollection':7}
+
+def _compress(data, compression):
+    if compression == 'zlib':
+        return zlib.compress(data)
+    elif compression == 'lz4':
+        import lz4.block
+        return lz4.block.compress(data)
+    return data
+
+def _decompress(data, code):
+    if code == 1:
+        return zlib.decompress(data)
+    elif code == 2:
+        import lz4.block
+        return lz4.block.decompress(data)
+    return data
+
+def _varints(values):
+    # zigzag varint encoding of an array of int64 values
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    nbytes = np.ones(len(zigzag), dtype=np.int64)
+    rest = zigzag >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(nbytes.sum(), dtype=np.uint8)
+    for i in range(nbytes.max()):
+        mask = nbytes > i
+        byte = (zigzag[mask] >> np.uint64(7*i)) & np.uint64(0x7f)
+        more = (nbytes[mask] > i + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + i] = byte | more
+    return out.tobytes()
+
+def _unvarints(data, offset=0):
+    # decode all the zigzag varints from offset to the end of the data
+    buf = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0:1] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((buf & 0x7f).astype(np.uint64) << (7 * shifts).astype(np.uint64), starts)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def _read_varint(data, offset):
+    # single zigzag varint, for reading the structure
+    value = shift = 0
+    while True:
+        byte = ord(data[offset])
+        value |= (byte & 0x7f) << shift
+        offset += 1
+        shift += 7
+        if byte < 0x80:
+            return (value >> 1) ^ -(value & 1), offset
+
+def _structure(shp, structure, coords):
+    # collects the structure codes and the coordinate arrays of a geometry
+    typ = _GEOMTYPES[shp.geom_type]
+    structure.append(typ)
+    if typ == 1:
+        coords.append(np.asarray(shp.coords))
+    elif typ == 2:
+        structure.append(len(shp.coords))
+        coords.append(np.asarray(shp.coords))
+    elif typ == 3:
+        rings = [shp.exterior] + list(shp.interiors)
+        structure.append(len(rings))
+        for ring in rings:
+            structure.append(len(ring.coords))
+            coords.append(np.asarray(ring.coords))
+    else:
+        structure.append(len(shp.geoms))
+        for part in shp.geoms:
+            _structure(part, structure, coords)
+
+def shapely_to_compact(shp, precision=6, compression=None):
+    # shapely to compact buffer
+    # points are smaller as wkb, which needs no envelope
+    if shp.is_empty or shp.has_z or shp.geom_type == 'Point':
+        return shapely_to_wkb(shp)
+    structure,coords = [],[]
+    _structure(shp, structure, coords)
+    coords = np.concatenate([c.reshape(-1, 2) for c in coords])
+    # round and take the difference from the previous coordinate
+    ints = np.round(coords * 10.0**precision).astype(np.int64)
+    deltas = np.diff(np.vstack([np.zeros((1,2), dtype=np.int64), ints]), axis=0)
+    payload = _varints(structure) + _varints(deltas.ravel())
+    # envelope of the rounded coordinates
+    rounded = ints / 10.0**precision
+    xmin,ymin = rounded.min(axis=0)
+    xmax,ymax = rounded.max(axis=0)
+    flags = 1 | (1 << 1) | COMPACT_FLAG
+    header = pack('<2sBBi4d', HEADER_MAGIC, 0, flags, 0, xmin, xmax, ymin, ymax)
+    body = pack('<bB', precision, COMPRESSIONS[compression]) + _compress(payload, compression)
+    return Binary(header + body)
+
+def _compact_to_wkb(buf, offset):
+    # compact encoding to plain wkb bytes
+    precision,compression = unpack_from('<bB', buf, offset)
+    data = _decompress(bytes(buf[offset+2:]), compression)
+
+    # read the structure, while building the wkb headers
+    # coordinates are given as slices until they have been decoded
+    parts = []
+    position = [0, 0] # data offset, coordinate index
+    def read():
+        value,position[0] = _read_varint(data, position[0])
+        return value
+    def coords(count):
+        parts.append(slice(position[1], position[1]+count))
+        position[1] += count
+    def geometry():
+        typ = read()
+        if typ == 1:
+            parts.append(pack('<BI', 1, typ))
+            coords(1)
+        elif typ == 2:
+            count = read()
+            parts.append(pack('<BII', 1, typ, count))
+            coords(count)
+        elif typ == 3:
+            rings = read()
+            parts.append(pack('<BII', 1, typ, rings))
+            for _ in range(rings):
+                count = read()
+                parts.append(pack('<I', count))
+                coords(count)
+        else:
+            count = read()
+            parts.append(pack('<BII', 1, typ, count))
+            for _ in range(count):
+                geometry()
+    geometry()
+
+    # decode all coordinates at once
+    deltas = _unvarints(data, position[0]).reshape(-1, 2)
+    values = (np.cumsum(deltas, axis=0) / 10.0**precision).astype('<f8')
+    return b''.join(values[part].tobytes() if isinstance(part, slice) else part
+                    for part in parts)
+
+def encode(geom, codec='wkb', precision=6, compression=None):
+    # shapely, geojson, proxy or geometry buffer to a buffer with the given encoding
+    if isinstance(geom, GeomProxy):
+        # keep as is if already encoded the same way
+        stored = geom.codec
+        if stored[0] == codec and (codec == 'wkb' or stored == (codec, precision, compression)):
+            return geom.wkb
+        geom = geom.geom
+    if isinstance(geom, dict):
+        geom = shape(geom)
+    elif not hasattr(geom, 'geom_type'):
+        geom = from_wkb(geom)
+    if codec == 'compact':
+        return shapely_to_compact(geom, precision, compression)
+    elif codec == 'wkb':
+        return shapely_to_wkb(geom)
+    raise Exception('Unknown geometry codec "{}", must be wkb or compact'.format(codec))
+
+_GEOMNAMES = dict((code,name) for name,code in _GEOMTYPES.items() if name != 'LinearRing')
+
+def wkb_geom_type(wkb_buf):
+    # geometry type name, read from the wkb or compact structure without parsing the geometry
+    flags,size = _header_info(wkb_buf)
+    if flags is not None and flags & COMPACT_FLAG:
+        (compression,) = unpack_from('<B', wkb_buf, size+1)
+        data = _decompress(bytes(wkb_buf[size+2:]), compression)
+        code,_ = _read_varint(data, 0)
+    else:
+        (byteorder,) = unpack_from('<B', wkb_buf, size)
+        endian = '<' if byteorder == 1 else '>'
+        (code,) = unpack_from(endian + 'I', wkb_buf, size+1)
+        code = (code & 0x0fffffff) % 1000
+    return _GEOMNAMES[code]
+
+def wkb_bounds(wkb_buf):
+    # wkb buffer to bbox in xmin,ymin,xmax,ymax order, or None if empty
+    flags,size = _header_info(wkb_buf)
+    if flags is not None:
+        endian = '<' if flags & 1 else '>'
+        if flags & (1 << 4):
+            # empty
+            return None
+        if (flags >> 1) & 7:
+            # cached envelope
+            xmin,xmax,ymin,ymax = unpack_from(endian + '4d', wkb_buf, 8)
+            return xmin,ymin,xmax,ymax
+    # no envelope, eg points or wkb stored without a header,
+    # so scan the coordinates directly from the wkb
+    xs,ys = [],[]
+    _scan_wkb(wkb_buf, size, xs, ys)
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+def _scan_wkb(wkb_buf, offset, xs, ys):
+    # collects the min and max x and y of each coordinate sequence in the wkb
+    # without creating any geometries, returns the offset where the geometry ends
+    (byteorder,) = unpack_from('<B', wkb_buf, offset)
+    endian = '<' if byteorder == 1 else '>'
+    (geomtype,) = unpack_from(endian + 'I', wkb_buf, offset+1)
+    offset += 5
+    # coordinate dimensions, either from ewkb flags or iso type codes
+    dims = 2 + bool(geomtype & 0x80000000) + bool(geomtype & 0x40000000)
+    if geomtype & 0x20000000:
+        offset += 4 # skip ewkb srid
+    geomtype &= 0x0fffffff
+    if geomtype >= 1000:
+        dims = (2, 3, 3, 4)[geomtype // 1000]
+        geomtype %= 1000
+
+    def scan_coords(offset, count):
+        if count:
+            coords = unpack_from(endian + '{}d'.format(count*dims), wkb_buf, offset)
+            x,y = coords[0::dims],coords[1::dims]
+            if x[0] == x[0]: # empty points are stored as nan
+                xs.extend((min(x),max(x)))
+                ys.extend((min(y),max(y)))
+        return offset + count*dims*8
+
+    if geomtype == 1:
+        # point
+        offset = scan_coords(offset, 1)
+    elif geomtype == 2:
+        # linestring
+        (count,) = unpack_from(endian + 'I', wkb_buf, offset)
+        offset = scan_coords(offset+4, count)
+    elif geomtype == 3:
+        # polygon, only the exterior ring is needed for the bbox
+        (rings,) = unpack_from(endian + 'I', wkb_buf, offset)
+        offset += 4
+        for i in range(rings):
+            (count,) = unpack_from(endian + 'I', wkb_buf, offset)
+            if i == 0:
+                offset = scan_coords(offset+4, count)
+            else:
+                offset += 4 + count*dims*8
+    else:
+        # multi geometries and collections
+        (parts,) = unpack_from(endian + 'I', wkb_buf, offset)
+        offset += 4
+        for _ in range(parts):
+            offset = _scan_wkb(wkb_buf, offset, xs, ys)
+    return offset
+
+
+class GeomProxy(object):
+    '''Lazy geometry returned when reading geom columns.
+    Holds the raw geometry blob, and only parses it into a shapely geometry the first time
+    it is needed. Bounds, type and emptiness are read directly from the blob. All other
+    attributes are those of the shapely geometry, which is also available as .geom.
+    Since the shapely geometry pointer is delegated as well, proxies can be passed directly
+    to shapely methods and functions. Inserting a proxy stores the original blob as is.
+    '''
+    __slots__ = ('wkb', '_shape')
+
+    def __init__(self, wkb):
+        self.wkb = wkb
+        self._shape = None
+
+    def __repr__(self):
+        return '<GeomProxy: {}>'.format(self.geom_type)
+
+    def __str__(self):
+        return str(self.geom)
+
+    def __getattr__(self, name):
+        return getattr(self.geom, name)
+
+    def __reduce__(self):
+        return GeomProxy, (bytes(self.wkb),)
+
+    def __eq__(self, other):
+        if isinstance(other, GeomProxy):
+            other = other.geom
+        return self.geom == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __nonzero__(self):
+        return not self.is_empty
+
+    @property
+    def geom(self):
+        if self._shape is None:
+            self._shape = from_wkb(self.wkb)
+        return self._shape
+
+    @property
+    def geom_type(self):
+        return wkb_geom_type(self.wkb)
+
+    @property
+    def type(self):
+        return self.geom_type
+
+    @property
+    def bounds(self):
+        bbox = wkb_bounds(self.wkb)
+        return bbox if bbox else ()
+
+    @property
+    def is_empty(self):
+        flags,_ = _header_info(self.wkb)
+        if flags is not None:
+            return bool(flags & (1 << 4))
+        return self.geom.is_empty
+
+    @property
+    def codec(self):
+        # (codec, precision, compression) of the stored blob
+        flags,size = _header_info(self.wkb)
+        if flags is not None and flags & COMPACT_FLAG:
+            precision,compression = unpack_from('<bB', self.wkb, size)
+            compression = dict((code,name) for name,code in COMPRESSIONS.items())[compression]
+            return 'compact', precision, compression
+        return 'wkb', None, None
+
+def proxy_to_wkb(proxy):
+    # no copy, sqlite binds the existing buffer
+    # but proxies that were pickled hold a byte string, which sqlite would store as text
+    return proxy.wkb if isinstance(proxy.wkb, buffer) else Binary(proxy.wkb)
+
+def geom_converter(wkb_bytes):
+    # sqlite gives converters a byte string, so wrap it as a buffer without copying
+    return GeomProxy(Binary(wkb_bytes))
 
 for geotype in [Point, MultiPoint, LineString, MultiLineString, Polygon, MultiPolygon]:
     sqlite3.register_adapter(geotype, shapely_to_wkb)
 sqlite3.register_adapter(dict, geoj_to_wkb)
-sqlite3.register_converter('geom', from_wkb)
+sqlite3.register_adapter(GeomProxy, proxy_to_wkb)
+sqlite3.register_converter('geom', geom_converter)
@@ -1,36 +1,67 @@
 
 import sqlite3
+from sqlite3 import Binary
 import os
 import shutil
 import warnings
-from itertools import izip, izip_longest
+import multiprocessing
+from itertools import izip, izip_longest, islice, repeat
 
 from . import vector
 from . import raster
 
 from . import stats
 from . import ops
+from . import indexes
 
 from .table import Table, Row
 from .verbose import track_progress
 
 sqlite3.enable_callback_tracebacks(True)
 
+# parallel raster import workers, each with their own file reader
+
+_worker_raster = None
+_worker_offline = False
+_worker_compression = None
+_worker_nodata_tiles = 'keep'
+
+def _import_worker_init(path, offline, compression, nodata_tiles, kwargs):
+    global _worker_raster, _worker_offline, _worker_compression, _worker_nodata_tiles
+    _worker_raster = raster.data.Raster(path, **kwargs)
+    _worker_offline = offline
+    _worker_compression = compression
+    _worker_nodata_tiles = nodata_tiles
+
+def _import_worker(window):
+    # reads and serializes the tile of a pixel window, or None if the tile is skipped
+    # blobs can't be pickled, so send as bytes
+    tile = _worker_raster.crop(window, worldcoords=False, offline=_worker_offline)
+    tile.compression = _worker_compression
+    if _worker_nodata_tiles != 'keep' and tile.is_nodata():
+        if _worker_nodata_tiles == 'skip':
+            return None
+        tile.compression = tile.compression or 'zlib'
+    return bytes(tile.wkb)
+
 class Workspace(object):
-    def __init__(self, path, mode='r'):
+    def __init__(self, path, mode='r', decode=True):
+        # with decode=False, geom and rast values are returned as raw blobs, see decode()
         self.path = path
         self.mode = mode
+        self.decode_types = decode
         self._connect()
         if self.mode == 'w':
             self._setup()
 
     def _connect(self):
         # connect to db
+        detect_types = sqlite3.PARSE_DECLTYPES if self.decode_types else 0 #|sqlite3.PARSE_COLNAMES
         if self.mode == 'w':
-            self.db = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES) #|sqlite3.PARSE_COLNAMES)
+            self.db = sqlite3.connect(self.path, detect_types=detect_types)
         elif self.mode == 'r':
             if os.path.exists(self.path):
-                self.db = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES) #|sqlite3.PARSE_COLNAMES)
+                self.db = sqlite3.connect(self.path, detect_types=detect_types)
                 self._fetchall('pragma query_only = ON')
             else:
                 raise Exception('No such database file path: "{}".'.format(self.path))
@@ -48,15 +79,51 @@ class Workspace(object):
         # connect to spatial indexes, if any
         self.spatial_indexes = dict() # where they are stored when loaded in memory
 
+        # geometry codecs of each table, loaded when first needed
+        self._geometry_codecs = None
+        # row encoders of each (table, fields), cleared whenever the codecs are reloaded
+        self._geometry_encoders = dict()
+
     def _setup(self):
         # TODO: make metatables start with _ underscore
         # and don't show when listing tables
         metatables = self.metatablenames
+        rebuild = []
+        if 'spatial_indexes' in metatables and 'rtree' not in self.table('spatial_indexes').fieldnames:
+            # workspaces created before the indexes were stored as sqlite rtrees,
+            # whose pickled indexes can't be used, so they are rebuilt as rtrees below
+            rebuild = self._fetchall('SELECT tbl, col FROM spatial_indexes')
+            self._fetchall('DROP TABLE spatial_indexes')
+            metatables = self.metatablenames
         if not 'spatial_indexes' in metatables:
             # create spatial index tables
-            fields = ['tbl', 'col', 'rtree_idx', 'rtree_dat']
-            typs = ['text', 'text', 'blob', 'blob']
+            fields = ['tbl', 'col', 'rtree']
+            typs = ['text', 'text', 'text']
             self.new_table('spatial_indexes', list(zip(fields, typs)))
+        if not 'geometry_codecs' in metatables:
+            # create table of geometry fields not stored as plain wkb
+            fields = ['tbl', 'col', 'codec', 'precision', 'compression']
+            typs = ['text', 'text', 'text', 'int', 'text']
+            self.new_table('geometry_codecs', list(zip(fields, typs)))
+        if not 'raster_grids' in metatables:
+            # create table of the tile grids of raster fields
+            fields = ['tbl', 'col', 'xscale', 'xskew', 'xoff', 'yskew', 'yscale', 'yoff',
+                      'tilewidth', 'tileheight', 'width', 'height', 'skipped']
+            typs = ['text', 'text', 'real', 'real', 'real', 'real', 'real', 'real',
+                    'int', 'int', 'int', 'int', 'int']
+            self.new_table('raster_grids', list(zip(fields, typs)))
+        elif 'skipped' not in self.table('raster_grids').fieldnames:
+            # workspaces created before skipped nodata tiles were counted
+            self._fetchall('ALTER TABLE raster_grids ADD COLUMN skipped int DEFAULT 0')
+        if not 'raster_overviews' in metatables:
+            # create table of the overview pyramid levels of raster fields
+            fields = ['tbl', 'col', 'factor', 'ovtbl', 'xres', 'yres', 'resampling']
+            typs = ['text', 'text', 'int', 'text', 'real', 'real', 'text']
+            self.new_table('raster_overviews', list(zip(fields, typs)))
+
+        for tbl,col in rebuild:
+            if tbl in self.tablenames and col in self.table(tbl).fieldnames:
+                self.table(tbl).create_spatial_index(col, verbose=False)
 
         # create crs/srs tables
         # ...
@@ -93,6 +160,8 @@ class Workspace(object):
         else:
             res = cur.execute(query).fetchall()
         cur.close()
+        # statement is finished, so parsed geometries are no longer needed
+        ops.clear_cache()
         return res
 
     def _cursor(self):
@@ -107,10 +176,8 @@ class Workspace(object):
         self.c.execute('COMMIT')
 
     def close(self):
-        # store back any unsaved spatial indexes
-        for (name,field),idx in self.spatial_indexes.items():
-            tbl = self.table(name)
-            tbl.store_spatial_index(field)
+        # release any loaded spatial indexes (these are always stored in the db)
+        self.spatial_indexes.clear()
         # close up the db
         self.db.commit()
         self.c.close()
@@ -135,7 +202,16 @@ class Workspace(object):
     def fork(self, path):
         self.db.commit()
         shutil.copyfile(self.path, path)
-        return Workspace(path, 'w')
+        return Workspace(path, 'w', decode=self.decode_types)
+
+    def decode(self, value, typ):
+        '''Convert a raw value the same way as reading a field of type typ, eg 'geom' or 'rast'.
+        For values read with decode=False, or from workspaces opened with decode=False.
+        '''
+        converter = sqlite3.converters.get(typ.split('(')[0].strip().upper())
+        if value is None or converter is None:
+            return value
+        return converter(bytes(value))
 
     # Metadata
 
@@ -157,10 +233,23 @@ class Workspace(object):
     @property
     def metatablenames(self):
         names = [row[0] for row in self._fetchall("SELECT name FROM sqlite_master WHERE type='table'")]
-        metanames = ('spatial_indexes',)
-        names = [n for n in names if n in metanames]
+        metanames = ('spatial_indexes','geometry_codecs','raster_grids','raster_overviews')
+        metaprefixes = (indexes.RTreeIndex.prefix, indexes._PyramidTableBackend.prefix)
+        names = [n for n in names if n in metanames or n.startswith(metaprefixes)]
         return tuple(names)
 
+    def geometry_codecs(self):
+        # dict of (table,field) to the (codec,precision,compression) of geometry fields not stored as plain wkb
+        if self._geometry_codecs is None:
+            if 'geometry_codecs' in self.metatablenames:
+                rows = self._fetchall('SELECT tbl, col, codec, precision, compression FROM geometry_codecs')
+                self._geometry_codecs = dict(((tbl,col),(codec,precision,compression))
+                                             for tbl,col,codec,precision,compression in rows)
+            else:
+                self._geometry_codecs = dict()
+            self._geometry_encoders = dict()
+        return self._geometry_codecs
+
     def table(self, name):
         return Table(self, name)
 
@@ -173,6 +262,7 @@ class Workspace(object):
     def new_table(self, name, fields, replace=False):
         # drop existing table if exists
         if replace:
+            self._drop_table_metadata(name)
             self._fetchall('DROP TABLE IF EXISTS {}'.format(name))
 
         # to save heartache later, auto replace problematic fieldname characters like underscore, period, etc.
@@ -242,13 +332,33 @@ class Workspace(object):
 
     def drop_table(self, name, confirm=False):
         if confirm and self.mode == 'w':
+            self._drop_table_metadata(name)
             self._fetchall('DROP TABLE {}'.format(name))
         else:
             raise Exception('To delete this table ({}) you must set confirm = True'.format(name))
 
-    def import_table(self, name, source, fieldnames=None, fieldtypes=None, select=None, keepfields=None, dropfields=None, sniffsize=10000, replace=False, verbose=True, **kwargs):
+    def _drop_table_metadata(self, name):
+        # drops the spatial indexes, codecs, overview levels and tile grids registered for a table
+        if name not in self.tablenames:
+            return
+        metatables = self.metatablenames
+        table = self.table(name)
+        if 'spatial_indexes' in metatables:
+            for col, in self._fetchall("SELECT col FROM spatial_indexes WHERE tbl = ?", (name,)):
+                table.drop_spatial_index(col)
+        if 'geometry_codecs' in metatables:
+            self._fetchall("DELETE FROM geometry_codecs WHERE tbl = ?", (name,))
+            self._geometry_codecs = None
+        if 'raster_overviews' in metatables:
+            for col, in self._fetchall("SELECT DISTINCT col FROM raster_overviews WHERE tbl = ?", (name,)):
+                table.drop_overviews(col)
+        if 'raster_grids' in metatables:
+            self._fetchall("DELETE FROM raster_grids WHERE tbl = ?", (name,))
+
+    def import_table(self, name, source, fieldnames=None, fieldtypes=None, select=None, keepfields=None, dropfields=None, sniffsize=10000, batchsize=10000, replace=False, verbose=True, **kwargs):
         # NOTE: use argname sniffsize for data detection, and sniffdialectsize for TextDelimited for detecting file structure
         # NOTE: kselect, eepfields and dropfields not yet implemented
+        # NOTE: rows are inserted in chunks of batchsize using executemany, set batchsize=None to insert one row at a time
         
         if isinstance(source, basestring):
             # load using format loaders
@@ -286,13 +396,8 @@ class Workspace(object):
                       for row,geo in source)
             
             # add the source rows
-            fails = 0
             self.begin()
-            for row in source:
-                try: table.add_row(*row)
-                except Exception as err:
-                    warnings.warn('One or more rows could not be added due to a problem: {}'.format(err))
-                    fails += 1
+            fails = self._insert_rows(table, source, batchsize)
             self.commit()
 
         # need to determine fields
@@ -370,19 +475,10 @@ class Workspace(object):
 
             # add the data from the sniffsample
             self.begin()
-            fails = 0
-            for row in sniffsample:
-                try: table.add_row(*row)
-                except Exception as err:
-                    warnings.warn('One or more rows could not be added due to a problem: {}'.format(err))
-                    fails += 1
+            fails = self._insert_rows(table, sniffsample, batchsize)
         
             # iterate and add what remains of the source
-            for row in source:
-                try: table.add_row(*row)
-                except Exception as err:
-                    warnings.warn('One or more rows could not be added due to a problem: {}'.format(err))
-                    fails += 1
+            fails += self._insert_rows(table, source, batchsize)
             self.commit()
 
         if fails > 0:
@@ -390,10 +486,65 @@ class Workspace(object):
 
         return table
 
+    def _insert_rows(self, table, rows, batchsize=None):
+        # insert rows into table, returning the number of rows that failed
+        # assumes a transaction has already been started
+        fails = 0
+        if not batchsize:
+            # one insert statement per row
+            for row in rows:
+                try: table.add_row(*row)
+                except Exception as err:
+                    warnings.warn('One or more rows could not be added due to a problem: {}'.format(err))
+                    fails += 1
+        else:
+            # chunks of rows through a single prepared statement
+            rows = iter(rows)
+            chunk = list(islice(rows, batchsize))
+            while chunk:
+                fails += self._insert_chunk(table, chunk)
+                chunk = list(islice(rows, batchsize))
+        return fails
+
+    def _insert_chunk(self, table, chunk):
+        # insert the chunk inside a savepoint so a bad row only undoes its own chunk
+        # failed chunks are split in half and retried until the bad rows are isolated
+        self.c.execute('SAVEPOINT insert_chunk')
+        try:
+            table.add_rows(chunk)
+        except Exception as err:
+            self.c.execute('ROLLBACK TO insert_chunk')
+            self.c.execute('RELEASE insert_chunk')
+            if len(chunk) == 1:
+                warnings.warn('One or more rows could not be added due to a problem: {}'.format(err))
+                return 1
+            half = len(chunk) // 2
+            return self._insert_chunk(table, chunk[:half]) + self._insert_chunk(table, chunk[half:])
+        self.c.execute('RELEASE insert_chunk')
+        return 0
+
     def import_raster(self, name, source,
-                      tilesize=None, tiles=None,
-                      replace=False, verbose=True, **kwargs):
-        
+                      tilesize=None, tiles=None, offline=False,
+                      workers=None, chunksize=100,
+                      overviews=None, resampling='mean', compression=None,
+                      nodata_tiles='keep', replace=False, verbose=True, **kwargs):
+        # NOTE: with offline=True, each tile only stores the file path and band numbers,
+        # and the pixels are read from the file when the tile data is accessed
+        # NOTE: with workers, file sources are read and serialized by a pool of worker processes,
+        # while the tiles are inserted here in transactions of chunksize tiles
+        # NOTE: overviews is the number of overview levels to build after importing, or True
+        # to build levels until one fits in a single tile, see Table.create_overviews()
+        # NOTE: compression is None, 'zlib' or 'lz4', and compresses the pixels of each tile,
+        # where bands that only contain nodata or a single value are stored as just that value
+        # NOTE: nodata_tiles is what to do with tiles where all bands only contain nodata, eg the
+        # ocean tiles of global datasets: 'keep' them, 'skip' them, or store a 'placeholder' with only
+        # the header and nodata values. Skipped tiles are counted in the raster_grids metatable, see
+        # table.tile_grid().skipped(), and reads of the grid treat them as nodata. Offline tiles must
+        # be read to be checked.
+        if nodata_tiles not in ('keep', 'skip', 'placeholder'):
+            raise Exception('nodata_tiles must be one of "keep", "skip" or "placeholder", not "{}"'.format(nodata_tiles))
+
+        tiler = None
         if isinstance(source, basestring):
             # load using format loaders
             rast = raster.data.Raster(source, **kwargs)
@@ -403,7 +554,14 @@ class Workspace(object):
 ##                for band in rast:
 ##                    band.nodataval = nodataval
 
-            source = rast.tiled(tilesize, tiles)
+            source = tiler = rast.tiled(tilesize, tiles, offline=offline)
+
+            if workers:
+                table = self._import_raster_parallel(name, source, offline, workers, chunksize,
+                                                     compression, nodata_tiles, replace, verbose, kwargs)
+                if overviews:
+                    table.create_overviews('rast', None if overviews is True else overviews, resampling, verbose=verbose)
+                return table
 
         if verbose:
             # by byte position in file
@@ -415,20 +573,21 @@ class Workspace(object):
             # by row
             source = track_progress(source, 'Importing raster "{}"'.format(name))
 
-        # determine fields
-        fields = []
-        fields += [('rast', 'rast')]
-
         # create the table
-        if name in self.tablenames:
-            table = self.table(name)
+        table,appended = self._raster_table(name, replace)
+
+        # tile positions in the grid, only known for file sources
+        if tiler is not None:
+            tw,th = tiler.tilesize
+            positions = ((y // th, x // tw) for x,y,_,_ in tiler.windows())
         else:
-            table = self.new_table(name, fields, replace=replace)
+            positions = repeat((None, None))
     
         # iterate and add what remains of the source
         self.begin()
         fails = 0
-        for tile in source:
+        skipped = 0
+        for tile,(row,col) in izip(source, positions):
             if 1:
                 #print tile
                 if isinstance(tile, raster.data.Raster):
@@ -443,7 +602,14 @@ class Workspace(object):
                         dtype = bandarr.dtype
                         rast.add_band(bandarr, dtype, width, height, nodataval)
                         
-                table.add_row(rast)
+                rast.compression = compression
+                if nodata_tiles != 'keep' and rast.is_nodata():
+                    if nodata_tiles == 'skip':
+                        skipped += 1
+                        continue
+                    # only the nodata flags of the bands are stored
+                    rast.compression = compression or 'zlib'
+                table.add_row(rast, row, col)
                 
             if 0: #except Exception as err:
                 warnings.warn('One or more tiles could not be added due to a problem: {}'.format(err))
@@ -454,5 +620,89 @@ class Workspace(object):
 
         self.commit()
 
+        self._register_grid(table, tiler, appended, skipped)
+        if tiler is None and skipped:
+            warnings.warn('Skipped {} tiles that only contained nodata, but their positions were not recorded'.format(skipped))
+
+        if overviews:
+            table.create_overviews('rast', None if overviews is True else overviews, resampling, verbose=verbose)
+
+        return table
+
+    def _import_raster_parallel(self, name, tiler, offline, workers, chunksize, compression, nodata_tiles, replace, verbose, kwargs):
+        windows = list(tiler.windows())
+        tw,th = tiler.tilesize
+
+        # create the table
+        table,appended = self._raster_table(name, replace)
+
+        pool = multiprocessing.Pool(workers, initializer=_import_worker_init,
+                                    initargs=(tiler.rast.filepath, offline, compression, nodata_tiles, kwargs))
+        try:
+            # in order, so the tiles are inserted in the same order as a serial import
+            blobs = pool.imap(_import_worker, windows)
+            if verbose:
+                blobs = track_progress(blobs, 'Importing raster "{}" with {} workers'.format(name, workers), total=len(windows))
+            positions = iter(windows)
+            skipped = 0
+            for chunk in iter(lambda: list(islice(blobs, chunksize)), []):
+                rows = [(Binary(blob), y // th, x // tw)
+                        for blob,(x,y,_,_) in izip(chunk, positions)
+                        if blob is not None]
+                skipped += len(chunk) - len(rows)
+                self.begin()
+                table.add_rows(rows)
+                self.commit()
+        finally:
+            pool.close()
+            pool.join()
+
+        self._register_grid(table, tiler, appended, skipped)
+
         return table
+
+    def _raster_table(self, name, replace):
+        # each raster tile is stored with its row and column in the tile grid
+        # returns the table and whether it already had tiles that are being appended to
+        fields = [('rast', 'rast'), ('tile_row', 'int'), ('tile_col', 'int')]
+        if name in self.tablenames and not replace:
+            table = self.table(name)
+            # tables imported before tile positions were recorded
+            for field,typ in fields[1:]:
+                if field not in table.fieldnames:
+                    table.add_field(field, typ)
+            appended = bool(table.get('COUNT(oid)'))
+        else:
+            table = self.new_table(name, fields, replace=replace)
+            appended = False
+        return table,appended
+
+    def _register_grid(self, table, tiler, appended, skipped=0):
+        # so that bbox queries can find the tiles arithmetically, see indexes.TileGridIndex
+        # tiler is None when the tiles were not cut from a file, so their positions are unknown
+        grid = indexes.TileGridIndex(self, table.name, 'rast')
+        if tiler is not None:
+            rast = tiler.rast
+            new = (list(rast.affine)[:6], tuple(tiler.tilesize), (rast.width, rast.height))
+        if not appended:
+            if tiler is not None:
+                grid.create(new[0], new[1], new[2], skipped)
+            return
+
+        # a table only has one grid, so when appending, the tiles must be cut from the same grid
+        current = grid.grid()
+        if current is None and tiler is None:
+            # never had a grid
+            return
+        unpositioned = table.get('COUNT(oid)', where='tile_row IS NULL')
+        if tiler is not None and current == new and not unpositioned:
+            # more tiles of the same grid, any skipped tiles were already counted
+            return
+
+        # tiles from different grids, or without positions, so fall back to the rtree
+        grid.drop()
+        warnings.warn('Table "{}" has tiles from more than one tile grid, or without tile positions, '
+                      'so its tiles are found with a spatial index instead'.format(table.name))
+        if not table.has_spatial_index('rast'):
+            table.create_spatial_index('rast', verbose=False)
                 
@@ -0,0 +1,48 @@
+
+import geostream as gs
+
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image, TiffImagePlugin
+
+# windowed reads of geotiffs with each compression, band layout and sample size,
+# compared against the full image decoded by PIL
+
+windows = [[0,0,120,90], [13,7,90,81], [110,80,120,90], [100,10,150,30], [60,40,61,41]]
+
+def save(path, arr, **kwargs):
+    info = TiffImagePlugin.ImageFileDirectory_v2()
+    info[33550] = (0.1, 0.1, 0.0); info.tagtype[33550] = 12
+    info[33922] = (0.0, 0.0, 0.0, 10.0, 50.0, 0.0); info.tagtype[33922] = 12
+    Image.fromarray(arr).save(path, tiffinfo=info, **kwargs)
+
+def check(path, arr):
+    reader = gs.raster.fileformats.geotiff.GeoTIFF(path)
+    ref = arr if arr.ndim == 3 else arr[:,:,None]
+    assert reader.bandcount == ref.shape[2], (reader.bandcount, ref.shape)
+    for band in range(reader.bandcount):
+        assert reader.dtype(band) == ref.dtype.name, (reader.dtype(band), ref.dtype)
+        for x1,y1,x2,y2 in windows:
+            expected = np.zeros((y2-y1, x2-x1), dtype=ref.dtype)
+            sub = ref[y1:y2, x1:x2, band]
+            expected[:sub.shape[0], :sub.shape[1]] = sub
+            assert (reader.data(band, [x1,y1,x2,y2]) == expected).all(), (path, band, (x1,y1,x2,y2))
+    return reader
+
+gray = (np.arange(90*120) % 251).reshape((90,120)).astype(np.uint8)
+rgb = np.dstack([gray, 255 - gray, gray // 2])
+uint16 = (np.arange(90*120) * 7 % 60000).reshape((90,120)).astype(np.uint16)
+
+folder = tempfile.mkdtemp()
+for name,arr in [('gray',gray), ('rgb',rgb), ('uint16',uint16), ('uint16 big endian',uint16.astype('>u2'))]:
+    for compression in [None, 'tiff_lzw', 'tiff_deflate', 'packbits']:
+        if arr.dtype.itemsize > 1 and compression == 'packbits':
+            continue
+        path = os.path.join(folder, 'test.tif')
+        save(path, arr, compression=compression)
+        reader = check(path, arr.astype(arr.dtype.newbyteorder('=')))
+        print name, compression, reader.bandcount, reader.dtype(0), 'windowed' if reader.layout else 'pil', 'ok'
+        os.remove(path)
+os.rmdir(folder)
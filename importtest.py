@@ -0,0 +1,42 @@
+
+import geostream as gs
+
+from time import time
+import random
+
+# compares rows/sec of the per-row and the batched executemany import paths
+
+TESTFILE = 'importtest.db'
+N = 200000
+
+def source():
+    for i in xrange(N):
+        x,y = random.uniform(-180,180), random.uniform(-90,90)
+        row = [i, 'place {}'.format(i), random.random()]
+        geoj = {'type':'Point', 'coordinates':(x,y)}
+        yield row, geoj
+
+fieldnames = ['id','name','value']
+fieldtypes = ['int','text','real']
+
+workspace = gs.Workspace(TESTFILE, 'w')
+
+for batchsize in [None, 1000, 10000, 100000]:
+    t = time()
+    workspace.import_table('points', source(), fieldnames=fieldnames, fieldtypes=fieldtypes,
+                           batchsize=batchsize, replace=True, verbose=False)
+    elapsed = time()-t
+    print 'batchsize', batchsize, '{:.0f} rows/sec'.format(N / elapsed)
+
+# bad rows are isolated within their chunk
+def badsource():
+    for i,(row,geoj) in enumerate(source()):
+        if i % 50000 == 0:
+            geoj = {'type':'Point', 'coordinates':'not a coordinate'}
+        yield row, geoj
+
+table = workspace.import_table('points', badsource(), fieldnames=fieldnames, fieldtypes=fieldtypes,
+                               batchsize=10000, replace=True, verbose=False)
+print 'imported', len(table), 'of', N
+
+workspace.delete(True)
@@ -0,0 +1,43 @@
+
+import geostream as gs
+
+from time import time
+import random
+
+from shapely.geometry import Point
+
+# country-by-city spatial join, comparing st_intersects with its bbox short-circuit
+# against always parsing both geometries and running the full predicate
+
+TESTFILE = 'jointest.db'
+CITIES = 300
+
+random.seed(1)
+
+def full_intersects(obj, other):
+    obj = gs.vector.serialize.from_wkb(obj)
+    other = gs.vector.serialize.from_wkb(other)
+    return obj.intersects(other)
+
+workspace = gs.Workspace(TESTFILE, 'w')
+workspace.db.create_function('full_intersects', 2, full_intersects)
+
+# countries as detailed polygons on a grid, cities as random points
+countries = workspace.new_table('countries', [('name','text'), ('geom','geom')], replace=True)
+cities = workspace.new_table('cities', [('name','text'), ('geom','geom')], replace=True)
+workspace.begin()
+countries.add_rows((('country {}'.format(i), Point(x*10, y*10).buffer(4, resolution=64))
+                    for i,(x,y) in enumerate((x,y) for x in range(-18,18) for y in range(-9,9))))
+cities.add_rows((('city {}'.format(i), Point(random.uniform(-180,180), random.uniform(-90,90)))
+                 for i in range(CITIES)))
+workspace.commit()
+
+for func in ['full_intersects', 'st_intersects']:
+    t = time()
+    query = 'SELECT COUNT(*) FROM countries AS c, cities AS p WHERE {}(c.geom, p.geom)'.format(func)
+    (matches,), = workspace._fetchall(query)
+    elapsed = time()-t
+    pairs = len(countries) * len(cities)
+    print func, matches, 'matches', '{:.3f} seconds'.format(elapsed), '({:.0f} pairs/sec)'.format(pairs / elapsed)
+
+workspace.delete(True)
@@ -27,7 +27,7 @@ def geog_pickle(geog):
     return dumps(geog)
 
 def geom_unpickle(geom_raw):
-    return gs.vector.serialize.wkb_loads(geom_raw)
+    return gs.vector.serialize.from_wkb(geom_raw)
 
 def geog_unpickle(geog_raw):
     return loads(geog_raw)
@@ -29,20 +29,19 @@ print origrast.affine
 ##workspace.clear(1)
 ##workspace.import_table('countries', r"C:\Users\kimok\Desktop\gazetteer data\raw\ne_10m_admin_0_countries.shp", replace=True)
 ##workspace.import_raster('globcover', r"P:\Freelance\Projects\Henry City Data\Work Files\Sources\GlobCover\GLOBCOVER_L4_200901_200912_V2.3.tif",
-##                        tilesize=(1000,1000), replace=True)
+##                        tilesize=(1000,1000), nodata_tiles='skip', replace=True)
 
 print workspace
 
 countries = workspace.table('countries')
 glob = workspace.table('globcover')
 
-##glob.create_spatial_index('rast')
+# no spatial index needed, the tiles are found from the tile grid recorded by import_raster
+print glob.tile_grid().grid()
+print glob.tile_grid().skipped(), 'ocean tiles skipped'
 
-for co in countries.select(['name','geom']):
-    print co[0]
-    isec = glob.intersection('rast', co[-1].bounds)
-    #viewrast(isec)
-    for (rast,) in isec:
-        data = rast.bands[0].data()
-        #print data.mean()
-        
+# statistics of the pixels within each country, streamed tile by tile
+names = dict(countries.select(['oid','name']))
+for oid,stats in countries.zonal_stats(glob):
+    print names[oid], stats['count'], stats['mean']
+    print stats['histogram']
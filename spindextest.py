@@ -0,0 +1,51 @@
+
+import geostream as gs
+
+import random
+
+from shapely.geometry import Point
+
+# spatial index queries on a small point table
+
+TESTFILE = 'spindextest.db'
+
+random.seed(1)
+points = [(random.uniform(-180,180), random.uniform(-90,90)) for _ in range(1000)]
+
+workspace = gs.Workspace(TESTFILE, 'w')
+table = workspace.new_table('points', [('name','text'), ('geom','geom')], replace=True)
+workspace.begin()
+table.add_rows((('point {}'.format(i), Point(x, y)) for i,(x,y) in enumerate(points)))
+workspace.commit()
+table.create_spatial_index('geom', verbose=False)
+
+bbox = [-20, -10, 30, 40]
+expected = set(i + 1 for i,(x,y) in enumerate(points)
+               if bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3])
+
+# the rowid is ambiguous in the join with the rtree, so must be selectable by any of its names
+for fields in (['oid'], ['rowid'], ['oid', 'name', 'geom']):
+    for decode in (True, False):
+        rows = list(table.intersection('geom', bbox, fields=fields, decode=decode))
+        assert set(row[0] for row in rows) == expected
+        print fields, decode, len(rows), 'ok'
+
+# workspaces from before the indexes were stored as rtrees are rebuilt when opened for writing
+table.drop_spatial_index('geom')
+workspace._fetchall('DROP TABLE spatial_indexes')
+workspace._fetchall('CREATE TABLE spatial_indexes (tbl text, col text, rtree_idx blob, rtree_dat blob)')
+workspace._fetchall("INSERT INTO spatial_indexes VALUES ('points', 'geom', NULL, NULL)")
+workspace.db.commit()
+workspace.close()
+
+workspace = gs.Workspace(TESTFILE, 'r')
+assert not workspace.table('points').has_spatial_index('geom')
+workspace.close()
+
+workspace = gs.Workspace(TESTFILE, 'w')
+table = workspace.table('points')
+rows = list(table.intersection('geom', bbox, fields=['oid']))
+assert set(row[0] for row in rows) == expected
+print 'rebuilt old index', len(rows), 'ok'
+
+workspace.delete(True)
@@ -0,0 +1,53 @@
+
+import geostream as gs
+from geostream.raster.wkb_raster import read_wkb_raster, write_wkb_raster
+
+import numpy as np
+from struct import pack
+
+# round trips of wkb rasters, for each kind of band and each type of blob that can be read:
+# bytearray (as returned by Raster.wkb), byte string, and buffer (as returned by sqlite)
+
+AFFINE = [0.1, 0, 10, 0, -0.1, 50]
+data = (np.arange(200) % 7).reshape((10,20)).astype(np.uint8)
+
+bands = {'offline': {'isOffline':True, 'hasNodataValue':True, 'isNodataValue':False, 'pixtype':4, 'nodata':0,
+                     'bandNumber':2, 'path':u'/data/landcover.tif'},
+         'pixels': {'isOffline':False, 'hasNodataValue':True, 'isNodataValue':False, 'pixtype':4, 'nodata':0,
+                    'ndarray':data},
+         'compressed': {'isOffline':False, 'hasNodataValue':True, 'isNodataValue':False, 'pixtype':4, 'nodata':0,
+                        'ndarray':data, 'compression':'zlib'},
+         }
+
+for name,band in sorted(bands.items()):
+    # two bands, so that anything after the first one is read from the right offset
+    wkb = write_wkb_raster([band, band], 20, 10, AFFINE)
+    for typ in (bytearray, bytes, buffer):
+        rast = read_wkb_raster(typ(wkb))
+        assert rast['width'] == 20 and rast['height'] == 10
+        for out in rast['bands']:
+            if band['isOffline']:
+                assert out['path'] == band['path'] and out['bandNumber'] == band['bandNumber']
+            else:
+                assert (out['ndarray'] == data).all()
+        print name, typ.__name__, 'ok'
+
+# and the same for a tile of an offline raster
+rast = gs.raster.data.Raster(None, 20, 10, AFFINE)
+rast.add_band(gs.raster.data.Band(None, None, 'uint8', 20, 10, nodataval=0, path='/data/landcover.tif', bandnum=0))
+out = read_wkb_raster(rast.wkb)
+print 'offline tile', out['bands'][0]['path'], out['bands'][0]['bandNumber']
+
+# big endian blobs are read without copying, so the bands keep the big endian dtype,
+# but must still be writable again
+pixels = (np.arange(200) * 300).reshape((10,20)).astype('>u2')
+scalex,skewx,offx,skewy,scaley,offy = AFFINE
+wkb = (pack('>BHHdddddd', 0, 0, 1, scalex, scaley, offx, offy, skewx, skewy) + pack('>iHH', 4326, 20, 10)
+       + pack('>BH', 6 | 64, 0) + pixels.tobytes())
+rast = gs.raster.serialize.from_wkb_buffer(bytearray(wkb))
+band = rast.bands[0]
+assert (band.data() == pixels).all()
+tile = rast.crop([0, 0, 10, 5], worldcoords=False)
+out = read_wkb_raster(tile.wkb)['bands'][0]
+assert (out['ndarray'] == pixels[:5,:10]).all()
+print 'big endian', band.data().dtype, '->', out['ndarray'].dtype, 'ok'